@@ -0,0 +1,45 @@
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional
+
+# Single-pass group-by: rows are hashed into groups by key and every group only
+# keeps running extremes, so picking the best/worst row per question or context
+# needs neither a global sort nor per-group row lists.
+
+
+class Extremes:
+    """Running max/min of the scored rows of a group, plus its unscored rows."""
+
+    __slots__ = ('max_row', 'max_score', 'min_row', 'min_score', 'count', 'rest')
+
+    def __init__(self):
+        self.max_row = self.min_row = None
+        self.max_score = self.min_score = None  # type: Optional[float]
+        self.count = 0
+        self.rest = []  # type: List[Any]
+
+    def add(self, row, score: Optional[float]):
+        if score is None:
+            self.rest.append(row)
+            return
+        # strict comparisons keep the first of equal rows, same as max() and min()
+        if self.count == 0 or score > self.max_score:
+            self.max_row, self.max_score = row, score
+        if self.count == 0 or score < self.min_score:
+            self.min_row, self.min_score = row, score
+        self.count += 1
+
+
+def group_extremes(rows: Iterable, key: Callable[[Any], Hashable],
+                   score: Callable[[Any], Optional[float]]) -> Dict[Hashable, Extremes]:
+    """Groups `rows` by `key(row)` in one pass, tracking the rows with the highest and lowest `score(row)`.
+
+    Rows scored `None` are not ranked and are collected in `Extremes.rest`. Groups come
+    out in the order their keys first appear.
+    """
+    groups = {}  # type: Dict[Hashable, Extremes]
+    for row in rows:
+        k = key(row)
+        group = groups.get(k)
+        if group is None:
+            group = groups[k] = Extremes()
+        group.add(row, score(row))
+    return groups
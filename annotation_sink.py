@@ -0,0 +1,251 @@
+import csv
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Optional, Sequence, Tuple, Type
+
+from dedup import ClaimedKeys, SeenKeys
+from tallies import Tallies, Tally
+
+# Handlers only enqueue rows; a writer thread appends them to the tsv in
+# groups, so a click never waits for the disk. Rows written in a forked worker
+# process (see sharding) are sent back to the writer thread of the parent.
+# Rows written with a key are recorded once per key (see dedup), and the
+# tallies of a recorded row are counted (see tallies).
+
+BATCH_SIZE = 200
+INTERVAL = 0.1
+FSYNC = os.environ.get('SENSE_BOT_FSYNC', '0') == '1'
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+
+_CLOSE = object()
+
+
+def _extend_header(filename: str, header: Sequence, encoding: Optional[str]):
+    """Rewrites the tsv `filename` with `header` if its own header is a shorter prefix of it, the
+    rows padded with empty cells, so rows appended with the added columns line up."""
+    with open(filename, newline='', encoding=encoding) as f:
+        old = next(csv.reader(f, delimiter='\t'), [])
+    if len(old) >= len(header) or old != list(header[:len(old)]):
+        return
+    padding = [''] * (len(header) - len(old))
+    with open(filename, newline='', encoding=encoding) as src, \
+            open(filename + '.tmp', 'w', newline='', encoding=encoding) as dst:
+        rows = csv.reader(src, delimiter='\t')
+        writer = csv.writer(dst, delimiter='\t')
+        next(rows)
+        writer.writerow(header)
+        writer.writerows(row + padding for row in rows)
+    os.replace(filename + '.tmp', filename)
+
+
+class AnnotationSink:
+    """Tab-separated annotation log written by a background thread.
+
+    Rows are committed (written and flushed, and fsynced with `fsync`) once `batch_size` rows
+    are queued or `interval` seconds after the first queued row. `close` drains the queue.
+    With `seen`, the file of recorded keys, a row whose key was recorded before is dropped and
+    counted in `suppressed`. The `tally` of each recorded row is added to `tallies`; `close` reports
+    the updates that failed. A batch that fails with one of `write_errors` is retried
+    `WRITE_ATTEMPTS` times; a batch that still fails, or fails otherwise, is logged, counted in
+    `lost` and not written, and the writer goes on with the next one.
+
+    Subclasses store the rows elsewhere by overriding `_open`, `_write` and `_close`.
+    """
+
+    write_errors = (OSError,)  # type: Tuple[Type[Exception], ...]
+
+    def __init__(self, filename: str, header: Optional[Sequence] = None, encoding: Optional[str] = None,
+                 batch_size: int = BATCH_SIZE, interval: float = INTERVAL, fsync: bool = FSYNC,
+                 seen: Optional[str] = None, tallies: Optional[Tallies] = None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+        self.seen_file = seen
+        self.tallies = tallies
+        self.suppressed = 0
+        self.lost = 0
+        self.claimed = ClaimedKeys(seen)
+        self._open(filename, header, encoding)
+
+        self.closed = False
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='annotation-sink', daemon=True)
+        self.thread.start()
+
+        self.remote = None
+        self.forwarding = False
+        os.register_at_fork(before=self._share, after_in_child=self._forward)
+
+    def _share(self):
+        if self.remote is None and not self.closed:
+            self.remote = multiprocessing.get_context('fork').Queue()
+            self.relay = threading.Thread(target=self._relay, name='annotation-relay', daemon=True)
+            self.relay.start()
+
+    def _relay(self):
+        while True:
+            item = self.remote.get()
+            if item is None:
+                return
+            self.queue.put(item)
+
+    def _forward(self):
+        self.forwarding = True
+
+    def claim(self, key: str) -> bool:
+        """Whether the answer with `key` is new; handlers check it before acting on an answer, the
+        writer drops a repeated row anyway."""
+        return self.claimed.claim(key)
+
+    def writerow(self, row: Sequence, key: Optional[str] = None, tally: Sequence[Tally] = ()):
+        if self.closed:
+            raise ValueError('write to a closed annotation sink')
+        (self.remote if self.forwarding else self.queue).put((row, key, tally))
+
+    def _open(self, filename: str, header: Optional[Sequence], encoding: Optional[str]):
+        exists = os.path.isfile(filename) and os.path.getsize(filename) > 0
+        if header is not None and exists:
+            _extend_header(filename, header, encoding)
+        self.file = open(filename, 'a', newline='', encoding=encoding)
+        self.writer = csv.writer(self.file, delimiter='\t')
+        if header is not None and not exists:
+            self.writer.writerow(header)
+            self._commit()
+
+    def _commit(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def _write(self, rows: list):
+        self.writer.writerows(rows)
+        self._commit()
+
+    def _close(self):
+        self.file.close()
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size and batch[-1] is not _CLOSE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _rollback(seen: SeenKeys):
+        try:
+            seen.rollback()
+        except sqlite3.Error as e:
+            print('annotation sink: failed to roll back recorded keys: {}'.format(e))
+
+    def _unique(self, items: list, seen: SeenKeys) -> list:
+        keys = [key for _, key, _ in items if key is not None]
+        try:
+            fresh = iter(seen.add_new(keys))
+        except sqlite3.Error as e:
+            # better a duplicate answer in the log than a lost one
+            print('annotation sink: failed to check keys, writing {} rows unchecked: {}'.format(len(items), e))
+            self._rollback(seen)
+            return items
+        unique = [item for item in items if item[1] is None or next(fresh)]
+        self.suppressed += len(items) - len(unique)
+        return unique
+
+    def _run(self):
+        # the key store is used by this thread only
+        seen = None
+        if self.seen_file:
+            try:
+                seen = SeenKeys(self.seen_file)
+            except sqlite3.Error as e:
+                print('annotation sink: failed to open {}, answers are not deduplicated: {}'.format(self.seen_file, e))
+        while True:
+            batch = self._next_batch()
+            closing = batch[-1] is _CLOSE
+            items = batch[:-1] if closing else batch
+            try:
+                self._record(items, seen)
+            except Exception as e:
+                # a writer that stopped would leave every later row queued and never written
+                self.lost += len(items)
+                print('annotation sink: lost {} rows: {!r}'.format(len(items), e))
+            if closing:
+                if seen is not None:
+                    try:
+                        seen.close()
+                    except sqlite3.Error as e:
+                        print('annotation sink: failed to close {}: {}'.format(self.seen_file, e))
+                return
+
+    def _write_retrying(self, items: list) -> bool:
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                self._write([row for row, _, _ in items])
+                return True
+            except self.write_errors as e:
+                print('annotation sink: failed to write {} rows (attempt {} of {}): {}'.format(
+                    len(items), attempt, WRITE_ATTEMPTS, e))
+                if attempt < WRITE_ATTEMPTS:
+                    time.sleep(RETRY_DELAY * attempt)
+        return False
+
+    def _record(self, items: list, seen: Optional[SeenKeys]):
+        if seen is not None:
+            items = self._unique(items, seen)
+        if items and not self._write_retrying(items):
+            self.lost += len(items)
+            if seen is not None:
+                self._rollback(seen)
+            return
+        if seen is not None and items:
+            try:
+                seen.commit()
+            except sqlite3.Error as e:
+                # the rows are written, a later duplicate of them may be too
+                print('annotation sink: failed to record the keys of {} rows: {}'.format(len(items), e))
+                self._rollback(seen)
+        if self.tallies is not None:
+            for _, _, tally in items:
+                if tally:
+                    self.tallies.add_answer(tally)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.forwarding:
+            # the file belongs to the parent
+            self.remote.close()
+            self.remote.join_thread()
+            return
+        if self.remote is not None:
+            # called after the forked processes are done
+            self.remote.put(None)
+            self.relay.join()
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        self._close()
+        if self.suppressed:
+            print('annotation sink: {} duplicate answers suppressed'.format(self.suppressed))
+        if self.lost:
+            print('annotation sink: {} rows could not be written and are lost'.format(self.lost))
+        if self.tallies is not None and self.tallies.failures:
+            print('annotation sink: {} tally updates failed, the live tallies are incomplete'.format(
+                self.tallies.failures))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
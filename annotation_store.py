@@ -0,0 +1,139 @@
+import csv
+import os
+import sqlite3
+import sys
+from typing import List, Optional, Sequence
+
+from annotation_sink import AnnotationSink
+from tallies import Tallies
+
+# Annotations of all runs of a bot in one SQLite file, as an alternative to a
+# tsv per run (SENSE_BOT_SINK=sqlite). Rows keep the columns of the bot's tsv
+# plus the run they belong to, and the columns analyses filter on are indexed:
+#
+#     select(store, "operator = ? AND discriminator > ?", ('botbest', 0.5))
+#
+# `export` writes the tsv of a run (or of any query) in the usual layout.
+
+SINK = os.environ.get('SENSE_BOT_SINK', 'tsv')
+# 'item' is the dataset position of the answered item, which every bot records
+INDEXED = ['chat_id', 'operator', 'question_id', 'item', 'time_asked']
+
+TABLE = 'annotations'
+
+
+def _quote(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _connect(filename: str) -> sqlite3.Connection:
+    db = sqlite3.connect(filename, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    return db
+
+
+def _columns(db: sqlite3.Connection) -> List[str]:
+    return [name for _, name, *_ in db.execute('PRAGMA table_info({})'.format(TABLE))]
+
+
+class AnnotationStore(AnnotationSink):
+    """AnnotationSink that inserts rows into the store `filename`, tagged with `run`.
+
+    A batch of rows is inserted in one transaction. The store must have been created with the
+    same `header`, or with its first columns, to which the others are then added; values keep their
+    types, so numeric columns compare as numbers."""
+
+    write_errors = (OSError, sqlite3.Error)
+
+    def __init__(self, filename: str, header: Sequence[str], run: str, **kwargs):
+        self.run = run
+        super().__init__(filename, header, **kwargs)
+
+    def _open(self, filename: str, header: Optional[Sequence], encoding: Optional[str]):
+        self.db = _connect(filename)
+        if not self.fsync:
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        columns = ['run'] + list(header)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(TABLE, ', '.join(map(_quote, columns))))
+            existing = _columns(self.db)
+            if existing == columns[:len(existing)]:
+                # rows of earlier runs have NULL in the columns added since
+                for name in columns[len(existing):]:
+                    self.db.execute('ALTER TABLE {} ADD COLUMN {}'.format(TABLE, _quote(name)))
+            if _columns(self.db) != columns:
+                raise ValueError('{} has columns {}, not {}'.format(filename, _columns(self.db), columns))
+            for name in ['run'] + [name for name in INDEXED if name in header]:
+                self.db.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    _quote('{}_{}'.format(TABLE, name)), TABLE, _quote(name)))
+        self.insert = 'INSERT INTO {} VALUES ({})'.format(TABLE, ', '.join('?' * len(columns)))
+
+    def _write(self, rows: list):
+        with self.db:
+            self.db.executemany(self.insert, [[self.run] + list(row) for row in rows])
+
+    def _close(self):
+        self.db.close()
+
+
+def open_sink(filename: str, header: Sequence[str], encoding: Optional[str] = None,
+              store: Optional[str] = None, seen: Optional[str] = None, tallies: Optional[Tallies] = None,
+              kind: str = SINK) -> AnnotationSink:
+    """The tsv sink `filename` or, with kind 'sqlite', the store `store` with the rows tagged by
+    the name of `filename`. `seen` is the file of recorded answer keys, `tallies` counts the
+    recorded answers."""
+    if kind == 'tsv':
+        return AnnotationSink(filename, header, encoding=encoding, seen=seen, tallies=tallies)
+    if kind == 'sqlite':
+        return AnnotationStore(store, header, os.path.splitext(os.path.basename(filename))[0], seen=seen,
+                               tallies=tallies)
+    raise ValueError('unknown annotation sink {!r}'.format(kind))
+
+
+def select(store: str, where: str = '1', params: Sequence = (), columns: str = '*') -> List[sqlite3.Row]:
+    db = _connect(store)
+    db.row_factory = sqlite3.Row
+    try:
+        return db.execute('SELECT {} FROM {} WHERE {}'.format(columns, TABLE, where), params).fetchall()
+    finally:
+        db.close()
+
+
+def runs(store: str) -> List[str]:
+    db = _connect(store)
+    try:
+        return [run for run, in db.execute('SELECT run FROM {} GROUP BY run ORDER BY min(rowid)'.format(TABLE))]
+    finally:
+        db.close()
+
+
+def export(store: str, filename: str, run: Optional[str] = None, where: str = '1', params: Sequence = (),
+           encoding: Optional[str] = None) -> int:
+    """Writes the rows of `run` (or all runs) matching `where` to the tsv `filename`, with the
+    header of the bot's own tsv. Returns the number of rows."""
+    if run is not None:
+        where, params = 'run = ? AND ({})'.format(where), [run] + list(params)
+    db = _connect(store)
+    try:
+        header = _columns(db)[1:]
+        rows = db.execute('SELECT {} FROM {} WHERE {} ORDER BY rowid'.format(
+            ', '.join(map(_quote, header)), TABLE, where), params)
+        with open(filename, 'w', newline='', encoding=encoding) as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(header)
+            count = 0
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        return count
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    # python annotation_store.py store [run] - lists the runs, or exports one to <run>.tsv
+    if len(sys.argv) < 3:
+        print('\n'.join(runs(sys.argv[1])))
+    else:
+        tsv = os.path.join(os.path.dirname(sys.argv[1]), sys.argv[2] + '.tsv')
+        print('{} rows written to {}'.format(export(sys.argv[1], tsv, sys.argv[2], encoding='utf-8'), tsv))
@@ -0,0 +1,101 @@
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+# Stratified balancing over integer operator codes. Rows are never copied: the
+# result is an index array into the candidates, so callers pick rows with it.
+#
+# Candidates are split into cells by (score bin, operator). Every bin is
+# balanced on its own: each operator keeps its first `n` rows in the bin, where
+# `n` comes from an exact quota or from a weighted ratio between operators.
+# Without quotas or weights all operators get the size of the smallest one,
+# the same as the old `zip(*operator_rows)` truncation.
+
+
+def operator_codes(rows: Iterable, operators: Sequence[str]) -> np.ndarray:
+    """Codes of `row.operator` by position in `operators`, -1 for operators not listed."""
+    codes = {op: i for i, op in enumerate(operators)}
+    return np.fromiter((codes.get(r.operator, -1) for r in rows), dtype=np.int64)
+
+
+def row_scores(rows: Iterable) -> np.ndarray:
+    """Discriminator scores of `rows`, NaN where a row has none."""
+    return np.fromiter((np.nan if r.discriminator is None else r.discriminator for r in rows), dtype=np.float64)
+
+
+def _cell_targets(counts: np.ndarray, quotas: Optional[np.ndarray], weights: Optional[np.ndarray],
+                  unscored: Optional[int] = None) -> np.ndarray:
+    if quotas is not None:
+        targets = np.broadcast_to(quotas, counts.shape).copy()
+        # bins no operator has rows in are not held to the quotas
+        targets[counts.sum(axis=1) == 0] = 0
+        # rows without a score are only kept where they fill every quota
+        if unscored is not None and (counts[unscored] < quotas).any():
+            targets[unscored] = 0
+        short = counts < targets
+        if short.any():
+            b, op = np.argwhere(short)[0]
+            raise ValueError('operator {} has {} rows in score bin {}, quota is {}'.format(
+                op, counts[b, op], b, quotas[op]))
+        return targets
+
+    if weights is None:
+        weights = np.ones(counts.shape[1])
+    used = weights > 0
+    if not used.any():
+        return np.zeros_like(counts)
+    # largest scale at which every weighted operator still has enough rows
+    scale = (counts[:, used] / weights[used]).min(axis=1)
+    return np.floor(scale[:, None] * weights[None, :] + 1e-9).astype(np.int64)
+
+
+def balance_index(operators: np.ndarray, n_operators: Optional[int] = None,
+                  quotas: Optional[Dict[int, int]] = None, weights: Optional[Dict[int, float]] = None,
+                  scores: Optional[np.ndarray] = None, bins: Optional[Sequence[float]] = None,
+                  shuffle: bool = True, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Indices of a balanced selection of candidates with the given operator codes.
+
+    `quotas` maps operator codes to the exact number of rows to keep per score bin, `weights`
+    to relative shares (operators without a weight are dropped); with both, quotas win. `scores`
+    and `bins` split the candidates into score bins as with np.digitize, missing (NaN) scores
+    forming a bin of their own. Quotas must be met in every score bin that has rows, else
+    ValueError; the rows without a score are left out when they cannot meet them. Candidates with a negative code are never selected. The result is shuffled unless
+    `shuffle` is false, in which case it is in input order.
+    """
+    operators = np.asarray(operators)
+    if n_operators is None:
+        n_operators = int(operators.max()) + 1 if len(operators) else 0
+
+    def per_operator(values, default):
+        if values is None:
+            return None
+        array = np.full(n_operators, default, dtype=np.float64 if isinstance(default, float) else np.int64)
+        for op, value in values.items():
+            array[op] = value
+        return array
+
+    n_bins = 1
+    unscored = None
+    strata = operators.astype(np.int32)
+    if bins is not None:
+        scores = np.asarray(scores, dtype=np.float64)
+        # same as np.digitize for increasing bins, but a few comparisons are much cheaper than a binary search
+        score_bins = np.zeros(len(scores), dtype=np.int32)
+        for edge in bins:
+            score_bins += scores >= edge
+        score_bins[np.isnan(scores)] = len(bins) + 1
+        n_bins = len(bins) + 2
+        unscored = len(bins) + 1
+        strata = np.where(operators >= 0, score_bins * n_operators + strata, -1)
+
+    counts = np.bincount(strata[strata >= 0], minlength=n_bins * n_operators)
+    targets = _cell_targets(counts.reshape(n_bins, n_operators),
+                            per_operator(quotas, 0), per_operator(weights, 0.0), unscored).ravel()
+    # there are only a few cells, so one vectorized scan per cell beats sorting all candidates
+    index = np.concatenate([np.flatnonzero(strata == cell)[:target] for cell, target in enumerate(targets)
+                            if target] or [np.empty(0, dtype=np.int64)])
+
+    if shuffle:
+        return (rng or np.random.default_rng()).permutation(index)
+    index.sort()
+    return index
@@ -0,0 +1,58 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+from collections import namedtuple
+from datetime import datetime, timedelta
+from typing import Optional
+
+# Buttons carry everything needed to record an answer, so nothing is kept on
+# the server between sending an item and the click. The token packs the item,
+# the order the answers were shown in, the time the item was sent and the
+# session nonce, and ends with a truncated HMAC: clients cannot forge or edit
+# it, and it stays valid across restarts for as long as the secret and the
+# dataset are the same.
+
+# defaults to a key derived from the bot token
+CALLBACK_SECRET = os.environ.get('SENSE_BOT_CALLBACK_SECRET')
+MAC_SIZE = 8
+
+_PACKED = struct.Struct('<IBQI')  # item, order, time asked in microseconds, nonce
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+Callback = namedtuple('Callback', 'item order time_asked nonce')
+
+
+class CallbackSigner:
+    """Encodes and verifies callback tokens: 34 base64url characters, leaving room for the
+    answer within Telegram's 64-byte callback_data.
+
+    `context` identifies what `item` refers to, e.g. the build of a dataset cache, so tokens
+    issued for another build do not verify."""
+
+    def __init__(self, secret: str, context: str = ''):
+        self.key = hmac.new(secret.encode(), context.encode(), hashlib.sha256).digest()
+        self.rejected = 0  # tokens that did not verify, in this process
+
+    def _mac(self, payload: bytes) -> bytes:
+        return hmac.new(self.key, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+    def encode(self, item: int, nonce: int, order: int = 0, time_asked: Optional[datetime] = None) -> str:
+        time_asked = time_asked or datetime.now()
+        payload = _PACKED.pack(item, order, (time_asked - _EPOCH) // _MICROSECOND, nonce)
+        return base64.urlsafe_b64encode(payload + self._mac(payload)).rstrip(b'=').decode('ascii')
+
+    def decode(self, token: str) -> Optional[Callback]:
+        """The fields of `token` with `time_asked` in isoformat, or None if it does not verify."""
+        try:
+            data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except ValueError:
+            data = b''
+        payload, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+        if len(payload) != _PACKED.size or not hmac.compare_digest(mac, self._mac(payload)):
+            self.rejected += 1
+            return None
+        item, order, time_asked, nonce = _PACKED.unpack(payload)
+        return Callback(item, order, (_EPOCH + time_asked * _MICROSECOND).isoformat(), nonce)
@@ -0,0 +1,442 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+from row_store import RowStore
+
+# Binary columnar cache of the prepared dataset rows.
+#
+# Layout: MAGIC, u64 header length, JSON header, then 8-byte aligned columns.
+# Column kinds: 'i' - int64, 'd' - float64 (None is stored as NaN),
+# 's' - int64 (offset, length) pairs into a utf-8 blob where equal strings share one entry.
+# Rendered columns (e.g. the message html of a row) are computed from the rows when the
+# table is written and follow the row fields as 's' columns.
+
+MAGIC = b'SBROWS02'
+_PREFIX = struct.Struct('<8sQ')
+_HASH_BLOCK = 1 << 20
+_TAIL_BLOCK = 1 << 16
+# a last record without a newline counts as complete once the file is left alone this long
+APPEND_GRACE = 5.0
+TEXT_CACHE_SIZE = 4096
+MEMOIZE_DISTINCT = 256
+
+
+def params_digest(params: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def file_digests(filename: str, lengths: Sequence[int]) -> List[Optional[str]]:
+    """Digests of the first `length` bytes of the file for each of the increasing `lengths`, in one read."""
+    h = hashlib.blake2b(digest_size=20)
+    digests = []
+    position = 0
+    with open(filename, 'rb') as f:
+        for length in lengths:
+            while position < length:
+                block = f.read(min(_HASH_BLOCK, length - position))
+                if not block:
+                    break
+                h.update(block)
+                position += len(block)
+            digests.append(h.hexdigest() if position == length else None)
+    return digests
+
+
+def file_digest(filename: str, length: Optional[int] = None) -> Optional[str]:
+    return file_digests(filename, [os.path.getsize(filename) if length is None else length])[0]
+
+
+def complete_size(filename: str, grace: float = APPEND_GRACE) -> int:
+    """Length of the file up to its last newline, i.e. without a record that is still being appended.
+    A file not modified for `grace` seconds is complete even without a final newline."""
+    with open(filename, 'rb') as f:
+        offset = size = f.seek(0, os.SEEK_END)
+        if time.time() - os.fstat(f.fileno()).st_mtime >= grace:
+            return size
+        while offset > 0:
+            step = min(_TAIL_BLOCK, offset)
+            f.seek(offset - step)
+            newline = f.read(step).rfind(b'\n')
+            if newline >= 0:
+                return offset - step + newline + 1
+            offset -= step
+    return 0
+
+
+def fingerprint(filename: str, size: Optional[int] = None) -> Dict[str, Any]:
+    """Identifies the first `size` bytes of the file (all of it by default)."""
+    st = os.stat(filename)
+    size = st.st_size if size is None else size
+    return {'size': size, 'file_size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': file_digest(filename, size)}
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _encode_column(kind: str, values: list) -> Tuple[bytes, int]:
+    """Returns the column data and its number of distinct strings (0 for numeric columns)."""
+    if kind == 'i':
+        return array('q', values).tobytes(), 0
+    if kind == 'd':
+        return array('d', (math.nan if v is None else v for v in values)).tobytes(), 0
+    if kind == 's':
+        # repeated strings (e.g. the context shared by all candidates) are stored once
+        offsets = array('q')
+        blob = bytearray()
+        stored = {}
+        for v in values:
+            offset = stored.get(v)
+            if offset is None:
+                data = v.encode('utf8')
+                offset = stored[v] = (len(blob), len(data))
+                blob += data
+            offsets.extend(offset)
+        return offsets.tobytes() + blob, len(stored)
+    raise ValueError('Unknown column kind {}'.format(kind))
+
+
+Renderers = Dict[str, Callable[[Any], str]]
+
+
+def write_table(filename: str, rows: Iterable[tuple], fields: Sequence[str], kinds: str,
+                meta: Optional[Dict[str, Any]] = None, rendered: Optional[Renderers] = None):
+    assert len(fields) == len(kinds), (fields, kinds)
+    rendered = rendered or {}
+    columns = [[] for _ in fields]
+    rendered_columns = [(fn, []) for fn in rendered.values()]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(value)
+        for fn, column in rendered_columns:
+            column.append(fn(row))
+    columns += [column for _, column in rendered_columns]
+    kinds += 's' * len(rendered)
+    n_rows = len(columns[0]) if columns else 0
+
+    chunks, distinct = zip(*(_encode_column(kind, column) for kind, column in zip(kinds, columns)))
+    # `build` tells apart tables written from the same input, whose rows may be in another order
+    header = {'fields': list(fields), 'rendered': list(rendered), 'kinds': kinds, 'rows': n_rows,
+              'distinct': distinct, 'meta': meta or {}, 'build': os.urandom(8).hex(), 'columns': []}
+    # column offsets depend on the header length, so settle it first
+    header_len = 0
+    while True:
+        offset = _align(_PREFIX.size + header_len)
+        header['columns'] = []
+        for chunk in chunks:
+            header['columns'].append([offset, len(chunk)])
+            offset = _align(offset + len(chunk))
+        encoded = json.dumps(header).encode('utf8')
+        if len(encoded) == header_len:
+            break
+        header_len = len(encoded)
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, len(encoded)))
+        f.write(encoded)
+        for (offset, _), chunk in zip(header['columns'], chunks):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(chunk)
+    os.replace(tmp, filename)
+
+
+class StringColumn(Sequence):
+    def __init__(self, buf: memoryview, n_rows: int, memoize: bool = False):
+        self.offsets = buf[:16 * n_rows].cast('q')
+        self.blob = buf[16 * n_rows:]
+        # equal strings share an offset, so low-cardinality columns (operators)
+        # are decoded once per distinct value
+        self.memo = {} if memoize else None
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __getitem__(self, i):
+        start = self.offsets[2 * i]
+        if self.memo is not None:
+            s = self.memo.get(start)
+            if s is None:
+                s = self.memo[start] = str(self.blob[start:start + self.offsets[2 * i + 1]], 'utf8')
+            return s
+        return str(self.blob[start:start + self.offsets[2 * i + 1]], 'utf8')
+
+
+class FloatColumn(Sequence):
+    def __init__(self, buf: memoryview):
+        self.values = buf.cast('d')
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        v = self.values[i]
+        return None if v != v else v
+
+
+class RowView:
+    """Row of a lazy RowTable: numeric fields are read from the mapped columns and text fields are
+    decoded on first use through the table's LRU of hot rows."""
+
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table: 'RowTable', index: int):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        return self._table.value(self._index, name)
+
+    def __getitem__(self, i):
+        return self._table.value(self._index, self._table.row_type._fields[i])
+
+    def __len__(self):
+        return len(self._table.row_type._fields)
+
+    def __iter__(self):
+        return iter(self._table.row(self._index))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(self._table.row(self._index))
+
+    def __reduce__(self):
+        # pickles as a plain row, without the mapped table
+        return self._table.row_type, tuple(self._table.row(self._index))
+
+
+class RowTable(Sequence):
+    """Memory-mapped rows of a cache file, decoded into `row_type` on access.
+
+    With `lazy_text` the table yields RowView objects that keep only the row index, and decoded
+    text is kept for the `text_cache_size` most recently used rows.
+    """
+
+    def __init__(self, filename: str, row_type, lazy_text: bool = False, text_cache_size: int = TEXT_CACHE_SIZE):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        magic, header_len = _PREFIX.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError('{} is not a dataset cache'.format(filename))
+        self.header = json.loads(str(buf[_PREFIX.size:_PREFIX.size + header_len], 'utf8'))
+        if list(row_type._fields) != self.header['fields']:
+            raise ValueError('Cache fields {} do not match {}'.format(self.header['fields'], row_type._fields))
+        self.row_type = row_type
+        self.meta = self.header['meta']
+        self.build = self.header.get('build', '')
+        self.n_rows = self.header['rows']
+        self.rendered = self.header.get('rendered', [])
+        self.columns = {}
+        self.text_fields = set()
+        names = self.header['fields'] + self.rendered
+        for name, kind, distinct, (offset, length) in zip(names, self.header['kinds'], self.header['distinct'],
+                                                          self.header['columns']):
+            data = buf[offset:offset + length]
+            if kind == 'i':
+                self.columns[name] = data.cast('q')
+            elif kind == 'd':
+                self.columns[name] = FloatColumn(data)
+            else:
+                memoize = distinct <= MEMOIZE_DISTINCT
+                self.columns[name] = StringColumn(data, self.n_rows, memoize)
+                if not memoize and name not in self.rendered:
+                    self.text_fields.add(name)
+        self._columns = [self.columns[name] for name in row_type._fields]
+        self.lazy_text = lazy_text
+        self.cached_row = lru_cache(maxsize=text_cache_size)(self.row)
+
+    def row(self, i: int):
+        return self.row_type(*(column[i] for column in self._columns))
+
+    def value(self, i: int, name: str):
+        if name in self.text_fields:
+            return getattr(self.cached_row(i), name)
+        try:
+            return self.columns[name][i]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n_rows))]
+        if i < 0:
+            i += self.n_rows
+        if not 0 <= i < self.n_rows:
+            raise IndexError(i)
+        return RowView(self, i) if self.lazy_text else self.row(i)
+
+    def by_id(self) -> 'RowsById':
+        return RowsById(self)
+
+
+class RowsById(Mapping):
+    """Id -> row view of a table whose rows were written in increasing id order."""
+
+    def __init__(self, table: RowTable):
+        self.table = table
+        self.ids = table.columns['id']
+
+    def __getitem__(self, row_id):
+        i = bisect_left(self.ids, row_id)
+        if i == len(self.ids) or self.ids[i] != row_id:
+            raise KeyError(row_id)
+        return self.table[i]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.table)
+
+    def values(self):
+        return self.table
+
+
+class RowGroups(Sequence):
+    """Consecutive fixed-size groups of rows, e.g. (best, random) pairs."""
+
+    def __init__(self, table: RowTable, size: int):
+        self.table = table
+        self.size = size
+
+    def __len__(self):
+        return len(self.table) // self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return tuple(self.table[i * self.size + j] for j in range(self.size))
+
+
+def _is_fresh(meta: Dict[str, Any], input_file: str, key: str) -> bool:
+    if meta.get('key') != key:
+        return False
+    source = meta.get('source', {})
+    st = os.stat(input_file)
+    if source.get('size') != st.st_size:
+        return False
+    if source.get('mtime_ns') == st.st_mtime_ns:
+        return True
+    return source.get('digest') == file_digest(input_file)
+
+
+def _open_table(filename: str, row_type, key: str, lazy_text: bool = False,
+                rendered: Optional[Renderers] = None) -> Optional[RowTable]:
+    if not os.path.isfile(filename):
+        return None
+    try:
+        table = RowTable(filename, row_type, lazy_text)
+    except ValueError as e:
+        print('Ignoring cache file {}: {}'.format(filename, e))
+        return None
+    if table.rendered != list(rendered or {}):
+        return None
+    return table if table.meta.get('key') == key else None
+
+
+def load_or_build(cache_file: str, input_file: str, params: Dict[str, Any], row_type, kinds: str,
+                  build: Callable[[], Iterable[tuple]], lazy_text: bool = False,
+                  rendered: Optional[Renderers] = None) -> RowTable:
+    """Opens `cache_file` if it was built from the current `input_file` with the same `params`,
+    otherwise rebuilds it from `build()`.
+
+    `rendered` maps names of extra text columns to functions of a row; they are evaluated once when
+    the cache is built and read back as attributes of the rows. Changes to these functions are not
+    detected, so `params` should carry a version of them.
+    """
+    key = params_digest(params)
+    table = _open_table(cache_file, row_type, key, lazy_text, rendered)
+    if table is not None:
+        if _is_fresh(table.meta, input_file, key):
+            return table
+        print('Cache file {} is stale'.format(cache_file))
+
+    print('Creating cache file {} ...'.format(cache_file))
+    source = fingerprint(input_file)
+    write_table(cache_file, build(), row_type._fields, kinds, {'key': key, 'params': params, 'source': source},
+                rendered)
+    print('Created!')
+    return RowTable(cache_file, row_type, lazy_text)
+
+
+def load_or_update(cache_file: str, input_file: str, params: Dict[str, Any], row_type, kinds: str,
+                   ingest: Callable[[RowStore, Optional[int], int], Any],
+                   select: Callable[[RowStore, Optional[Set[str]]], Iterable],
+                   arrange: Callable[[List[tuple], Iterable], Iterable[tuple]], lazy_text: bool = False,
+                   rendered: Optional[Renderers] = None) -> RowTable:
+    """Like load_or_build, for datasets selected from per-context groups of the input rows.
+
+    The ingested groups are kept in `cache_file + '.store'` together with the ingested length of
+    `input_file`. `ingest(store, start, end)` appends the records in that byte range to the store
+    (`start` is None for a full read). `select(store, contexts)` selects items from the given contexts
+    (all of them for None) and `arrange(kept_rows, items)` makes the rows to cache from them.
+
+    When `input_file` has only been appended to, just the new records are ingested and only the
+    contexts they touched are selected again; the cached rows of other contexts are kept.
+    `rendered` columns are added to the cached rows as with load_or_build.
+    """
+    key = params_digest(params)
+    store_file = cache_file + '.store'
+    table = _open_table(cache_file, row_type, key, rendered=rendered)
+    store_table = _open_table(store_file, row_type, key)
+
+    source = start = None
+    if store_table is not None:
+        old = store_table.meta['source']
+        st = os.stat(input_file)
+        # a held back last record is picked up once complete_size counts it, even if the file is unchanged
+        if (old['file_size'], old['mtime_ns']) == (st.st_size, st.st_mtime_ns) and old['size'] == st.st_size:
+            source = old
+        else:
+            end = complete_size(input_file)
+            prefix_digest, digest = file_digests(input_file, [old['size'], end]) if end >= old['size'] else [None, None]
+            if prefix_digest == old['digest']:
+                source = {'size': end, 'file_size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest}
+        if source is not None:
+            start = old['size']
+            is_current = table is not None and table.meta['source'] == old
+            if source['size'] == start and is_current:
+                return RowTable(cache_file, row_type, lazy_text)
+
+    store = RowStore(row_type)
+    if start is None:
+        print('Creating cache file {} ...'.format(cache_file))
+        source = fingerprint(input_file, complete_size(input_file))
+        ingest(store, None, source['size'])
+        kept, contexts = [], None
+    else:
+        print('Updating cache file {} with {} appended bytes ...'.format(cache_file, source['size'] - start))
+        store.extend(store_table)
+        n_rows = store.n_rows
+        ingest(store, start, source['size'])
+        if is_current:
+            contexts = {store.contexts[code] for code in store.context_codes[n_rows:]}
+            kept = [row for row in table if row.context not in contexts]
+        else:
+            kept, contexts = [], None
+
+    meta = {'key': key, 'params': params, 'source': source}
+    write_table(store_file, store.rows(), row_type._fields, kinds, meta)
+    write_table(cache_file, arrange(kept, select(store, contexts)), row_type._fields, kinds, meta, rendered)
+    print('Created!')
+    return RowTable(cache_file, row_type, lazy_text)
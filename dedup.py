@@ -0,0 +1,189 @@
+import collections
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+# Answers are recorded once per key (chat and callback token): double taps and
+# redelivered callbacks carry the same token. Every recorded key is kept in a
+# SQLite table; a Bloom filter in memory answers "never seen" for new keys, so
+# only the rare repeated (or falsely positive) key costs a lookup. The filter
+# is saved next to the keys on close, so a restart does not rehash every key.
+# Handlers claim a key before they act on the answer (see ClaimedKeys), so a
+# repeated callback does not advance the session either.
+
+CAPACITY = 1 << 20
+ERROR_RATE = 0.001
+RECENT = 100000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS filters (capacity INTEGER, error_rate REAL, count INTEGER, bits BLOB);
+'''
+
+
+def key_digest(key: str) -> bytes:
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+class BloomFilter:
+    """Set membership with false positives at `error_rate` up to `capacity` digests.
+
+    Bit positions come from double hashing the two halves of a 16-byte digest."""
+
+    def __init__(self, capacity: int = CAPACITY, error_rate: float = ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest: bytes) -> Iterable[int]:
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, digest: bytes):
+        bits = self.bits
+        for position in self._positions(digest):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+
+class ScalableBloomFilter:
+    """Bloom filters of doubling capacity and halving error rate, so the overall rate stays
+    below `2 * error_rate` however many digests are added."""
+
+    def __init__(self, capacity: int = CAPACITY, error_rate: float = ERROR_RATE):
+        self.filters = [BloomFilter(capacity, error_rate / 2)]
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
+
+    def add(self, digest: bytes):
+        last = self.filters[-1]
+        if last.count >= last.capacity:
+            last = BloomFilter(last.capacity * 2, last.error_rate / 2)
+            self.filters.append(last)
+        last.add(digest)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return any(digest in f for f in self.filters)
+
+
+class SeenKeys:
+    """Durable set of recorded keys. Not thread-safe: meant for the annotation writer thread."""
+
+    def __init__(self, filename: str, capacity: int = CAPACITY, error_rate: float = ERROR_RATE):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # committed after the annotations they belong to, which is what a crash may lose
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(_SCHEMA)
+        self.filter = self._load_filter() or self._build_filter(capacity, error_rate)
+        self.lookups = 0
+
+    def _load_filter(self) -> Optional[ScalableBloomFilter]:
+        saved = self.db.execute('SELECT capacity, error_rate, count, bits FROM filters ORDER BY rowid').fetchall()
+        # keys added after the filter was saved (by a run that did not close) need a rebuild
+        if not saved or sum(count for _, _, count, _ in saved) != self._count():
+            return None
+        scalable = ScalableBloomFilter()
+        scalable.filters = []
+        for capacity, error_rate, count, bits in saved:
+            f = BloomFilter(capacity, error_rate)
+            f.count, f.bits = count, bytearray(bits)
+            scalable.filters.append(f)
+        return scalable
+
+    def _build_filter(self, capacity: int, error_rate: float) -> ScalableBloomFilter:
+        scalable = ScalableBloomFilter(capacity, error_rate)
+        for digest, in self.db.execute('SELECT key FROM seen'):
+            scalable.add(digest)
+        return scalable
+
+    def _count(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def add_new(self, keys: Iterable[str]) -> List[bool]:
+        """Adds `keys` and tells for each whether it was new; a key repeated within `keys` is new
+        only the first time. The new keys are stored by `commit`."""
+        fresh, digests = [], []
+        for key in keys:
+            digest = key_digest(key)
+            is_new = digest not in self.filter
+            if not is_new:
+                self.lookups += 1
+                is_new = self.db.execute('SELECT 1 FROM seen WHERE key = ?', (digest,)).fetchone() is None
+                # a key repeated within the batch is already in the filter but not yet stored
+                is_new = is_new and digest not in digests
+            if is_new:
+                self.filter.add(digest)
+                digests.append(digest)
+            fresh.append(is_new)
+        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(d,) for d in digests])
+        return fresh
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        # the filter keeps the digests, which only costs lookups
+        self.db.rollback()
+
+    def close(self):
+        with self.db:
+            self.db.execute('DELETE FROM filters')
+            self.db.executemany('INSERT INTO filters VALUES (?, ?, ?, ?)',
+                                [(f.capacity, f.error_rate, f.count, bytes(f.bits)) for f in self.filter.filters])
+        self.db.close()
+
+
+class ClaimedKeys:
+    """Keys of the answers handlers acted on. The last `recent` are kept in memory, older ones are
+    looked up among the keys recorded in `filename`, read only. Thread-safe; a forked worker process
+    (see sharding) keeps the keys claimed so far, its chats' answers all go to it."""
+
+    def __init__(self, filename: Optional[str] = None, recent: int = RECENT):
+        self.filename = filename
+        self.recent = recent
+        self.keys = set()
+        self.order = collections.deque()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # the inherited connection must not be used in the child
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _recorded(self, digest: bytes) -> bool:
+        if self.filename is None:
+            return False
+        try:
+            if self.db is None:
+                self.db = sqlite3.connect('file:{}?mode=ro'.format(self.filename), uri=True, check_same_thread=False)
+            return self.db.execute('SELECT 1 FROM seen WHERE key = ?', (digest,)).fetchone() is not None
+        except sqlite3.Error as e:
+            # e.g. the writer has not created the table yet; its dedup still drops a repeated row
+            print('claimed keys: lookup in {} failed: {}'.format(self.filename, e))
+            self.db = None
+            return False
+
+    def claim(self, key: str) -> bool:
+        """True if `key` was not claimed or recorded before, and claims it."""
+        digest = key_digest(key)
+        with self.lock:
+            if digest in self.keys or self._recorded(digest):
+                return False
+            self.keys.add(digest)
+            self.order.append(digest)
+            if len(self.order) > self.recent:
+                self.keys.discard(self.order.popleft())
+            return True
@@ -0,0 +1,89 @@
+import csv
+import io
+import locale
+import os
+from collections import Counter
+from contextlib import nullcontext
+from multiprocessing import Pool
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from markup import TEXT_FIRST, Utterance, parse_records
+
+# Parallel ingestion of the model-output csv: the file is split into
+# newline-aligned byte ranges that are parsed in a process pool and yielded
+# back in file order, so row numbering is the same as with read_dialogs.
+# Records are assumed not to contain raw newlines, which holds for the
+# single-line `<TAG> text` dialog exports.
+
+CHUNK_SIZE = 32 << 20
+
+ByteRange = Tuple[int, int]
+
+
+def _next_line_start(f, offset: int) -> int:
+    f.seek(offset)
+    f.readline()
+    return f.tell()
+
+
+def byte_ranges(filename: str, chunk_size: int = CHUNK_SIZE, start: Optional[int] = None,
+                end: Optional[int] = None) -> List[ByteRange]:
+    """Splits the records between `start` (the end of the header by default) and `end`
+    into newline-aligned ranges."""
+    size = os.path.getsize(filename) if end is None else end
+    ranges = []
+    with open(filename, 'rb') as f:
+        offset = _next_line_start(f, 0) if start is None else start
+        while offset < size:
+            end = size if offset + chunk_size >= size else _next_line_start(f, offset + chunk_size - 1)
+            ranges.append((offset, end))
+            offset = end
+    return ranges
+
+
+def read_header(filename: str, encoding: Optional[str] = None) -> List[str]:
+    with open(filename, encoding=encoding) as f:
+        return next(csv.reader(f, delimiter=','))
+
+
+def read_range(filename: str, byte_range: ByteRange, columns: Sequence[str] = TEXT_FIRST,
+               strip_context: bool = False, encoding: Optional[str] = None) -> Tuple[List[Utterance], Counter]:
+    start, end = byte_range
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    skipped = Counter()
+    records = csv.reader(io.StringIO(data.decode(encoding or locale.getpreferredencoding(False)), newline=''),
+                         delimiter=',')
+    return list(parse_records(records, columns, skipped, strip_context)), skipped
+
+
+def _read_range(args):
+    return read_range(*args)
+
+
+def ingest_dialogs(filename: str, columns: Sequence[str] = TEXT_FIRST, skipped: Optional[Counter] = None,
+                   strip_context: bool = False, encoding: Optional[str] = None,
+                   header: Optional[Sequence[str]] = None, workers: Optional[int] = None,
+                   chunk_size: int = CHUNK_SIZE, start: Optional[int] = None,
+                   end: Optional[int] = None) -> Iterator[Utterance]:
+    """Same as markup.read_dialogs, but parses byte ranges of the file in `workers` processes.
+
+    `start` and `end` limit parsing to the records in that byte range of the file.
+    """
+    if skipped is None:
+        skipped = Counter()
+    if header is not None and start is None:
+        first = read_header(filename, encoding)
+        assert first == list(header), first
+
+    tasks = [(filename, r, columns, strip_context, encoding) for r in byte_ranges(filename, chunk_size, start, end)]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+
+    with (Pool(workers) if workers > 1 else nullcontext()) as pool:
+        # imap keeps the chunks in file order, so context groups and row ids
+        # come out exactly as with a sequential read
+        results = pool.imap(_read_range, tasks) if pool else map(_read_range, tasks)
+        for utterances, chunk_skipped in results:
+            skipped.update(chunk_skipped)
+            yield from utterances
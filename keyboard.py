@@ -0,0 +1,22 @@
+from typing import List, Sequence, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+TOKEN = '{token}'
+
+
+class KeyboardTemplate:
+    """Inline keyboard serialized once. `render(token)` returns the reply_markup json for one send,
+    with `token` substituted into the callback data of every button.
+
+    Buttons are `(text, callback_data)` pairs where the callback data formats the token with `{}`,
+    e.g. `('Осмысленно', '{};1')`. The token must not need json escaping.
+    """
+
+    def __init__(self, buttons: Sequence[Sequence[Tuple[str, str]]]):
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=data.format(TOKEN))
+                                        for text, data in row] for row in buttons])
+        self.parts = markup.to_json().split(TOKEN)  # type: List[str]
+
+    def render(self, token: str) -> str:
+        return token.join(self.parts)
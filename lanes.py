@@ -0,0 +1,67 @@
+import functools
+import os
+import queue
+import threading
+from typing import Callable
+
+# Handlers block on Telegram requests, so updates are handled on a pool of
+# worker threads. Every chat is pinned to one worker: updates of the same chat
+# run one after another in arrival order, different chats run in parallel.
+
+CHAT_WORKERS = int(os.environ.get('SENSE_BOT_CHAT_WORKERS', '16'))
+
+
+def chat_id_of(update) -> int:
+    if getattr(update, 'callback_query', None) is not None:
+        return update.callback_query.message.chat_id
+    return update.message.chat_id
+
+
+class ChatLanes:
+    def __init__(self, dispatcher=None, workers: int = CHAT_WORKERS):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self._start()
+        # threads do not survive a fork, a forked worker process starts its own (see sharding)
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self.queues = [queue.Queue() for _ in range(self.workers)]
+        self.threads = [threading.Thread(target=self._run, args=(q,), name='chat-lane-{}'.format(i), daemon=True)
+                        for i, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, tasks: queue.Queue):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            fn, args = task
+            fn(*args)
+
+    def submit(self, chat_id: int, fn: Callable, *args):
+        self.queues[hash(chat_id) % len(self.queues)].put((fn, args))
+
+    def _call(self, callback: Callable, bot, update):
+        try:
+            callback(bot, update)
+        except Exception as e:
+            if self.dispatcher is None:
+                print(e)
+            else:
+                self.dispatcher.dispatch_error(update, e)
+
+    def wrap(self, callback: Callable) -> Callable:
+        """Turns a `(bot, update)` handler into one that runs in the lane of the update's chat."""
+        @functools.wraps(callback)
+        def handler(bot, update):
+            self.submit(chat_id_of(update), self._call, callback, bot, update)
+        return handler
+
+    def close(self):
+        """Waits until the updates submitted so far are handled."""
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,94 @@
+import csv
+import re
+from collections import Counter, namedtuple
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Every dialog line is a sequence of `<TAG> text` chunks, e.g.
+# `<COR_START> client question <ANS_START> operator answer`.
+TAG_RE = re.compile(r'<([A-Z_]+)> [^<>]*')
+
+ANSWER_TAG = 'ANS_START'
+QUESTION_TAG = 'COR_START'
+SKIP_TAGS = {'MAN_START': 'man_start', 'PAUSE': 'pause'}
+
+# column layouts of the model-output exports
+TEXT_FIRST = ('text', 'is_human', 'discriminator')
+LABEL_FIRST = ('is_human', 'text', 'discriminator')
+
+Token = Tuple[str, int, int]
+Dialog = namedtuple('Dialog', 'context question answer')
+Utterance = namedtuple('Utterance', 'context question answer is_human discriminator')
+
+
+class SkipRow(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def is_greeting(answer: str) -> bool:
+    answer = answer.lower()
+    return ('здравствуйте' in answer) and ('cлужба технической поддержки' in answer)
+
+
+def parse_spans(text: str) -> Tuple[int, Token, Token]:
+    """Returns the context end offset and the question and answer tokens of a dialog line."""
+    context_end = -1
+    question = answer = None
+    for m in TAG_RE.finditer(text):
+        tag = m.group(1)
+        if context_end < 0 and tag == ANSWER_TAG and m.start() > 0 and text[m.start() - 1] == ' ':
+            context_end = m.start() - 1
+        question, answer = answer, (tag, m.end(1) + 2, m.end())
+
+    if answer is None:
+        raise SkipRow('truncated')
+    assert answer[0] == ANSWER_TAG, text
+    if question is None:
+        raise SkipRow('truncated')
+    if question[0] in SKIP_TAGS:
+        raise SkipRow(SKIP_TAGS[question[0]])
+    assert question[0] == QUESTION_TAG, [text[question[1]:question[2]], text]
+
+    return (len(text) if context_end < 0 else context_end), question, answer
+
+
+def parse_dialog(text: str, strip_context: bool = False) -> Dialog:
+    context_end, (_, q_start, q_end), (_, a_start, a_end) = parse_spans(text)
+    answer = text[a_start:a_end]
+    if is_greeting(answer):
+        raise SkipRow('greeting')
+    context = text[:context_end]
+    if strip_context:
+        context = context.strip()
+    return Dialog(context, text[q_start:q_end], answer)
+
+
+def parse_records(records: Iterable[List[str]], columns: Sequence[str], skipped: Counter,
+                  strip_context: bool = False) -> Iterator[Utterance]:
+    text_col, label_col, score_col = (columns.index(c) for c in ('text', 'is_human', 'discriminator'))
+    for record in records:
+        if not record:
+            # a blank line, e.g. the newline appended after a last record that had none
+            continue
+        try:
+            context, question, answer = parse_dialog(record[text_col], strip_context)
+        except SkipRow as e:
+            skipped[e.reason] += 1
+            continue
+        yield Utterance(context, question, answer, record[label_col], record[score_col])
+
+
+def read_dialogs(filename: str, columns: Sequence[str] = TEXT_FIRST, skipped: Optional[Counter] = None,
+                 strip_context: bool = False, encoding: Optional[str] = None,
+                 header: Optional[Sequence[str]] = None) -> Iterator[Utterance]:
+    """Streams parsed dialogs from a model-output csv, counting skipped rows by reason in `skipped`."""
+    if skipped is None:
+        skipped = Counter()
+
+    with open(filename, encoding=encoding) as f:
+        csvfile = csv.reader(f, delimiter=',')
+        first = next(csvfile)
+        if header is not None:
+            assert first == list(header), first
+        yield from parse_records(csvfile, columns, skipped, strip_context)
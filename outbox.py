@@ -0,0 +1,182 @@
+import collections
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from sharding import PROCESSES
+
+# Outgoing messages are throttled by token buckets before they reach the Bot
+# API: one shared by all chats and one per chat, with the limits Telegram
+# documents for bots. Handlers only queue a message; sender threads deliver
+# each chat's messages in order once both buckets allow, so a throttled chat
+# never holds up the lane (see lanes) it shares with other chats. A 429
+# (RetryAfter) is a bot-wide limit: it pauses every chat for the time Telegram
+# asks for, and the message is sent again. Worker processes (see sharding) each
+# get an equal share of the global rate; a chat is only served by one of them.
+
+GLOBAL_RATE = float(os.environ.get('SENSE_BOT_GLOBAL_RATE', '30'))
+CHAT_RATE = float(os.environ.get('SENSE_BOT_CHAT_RATE', '1'))
+CHAT_BURST = 3
+RETRIES = 5
+SENDERS = int(os.environ.get('SENSE_BOT_SENDERS', '4'))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds to wait before it may be used.
+
+        Tokens may go negative, which queues callers in the order they reserved."""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class _Message:
+    __slots__ = ('text', 'kwargs', 'attempt', 'reserved')
+
+    def __init__(self, text: str, kwargs: dict):
+        self.text = text
+        self.kwargs = kwargs
+        self.attempt = 0
+        self.reserved = False
+
+
+class Outbox:
+    """Rate-limited `send_message` that queues the message and returns at once.
+
+    Messages of a chat are sent in the order they were queued. `close` waits for the queued ones.
+    """
+
+    def __init__(self, bot, rate: float = GLOBAL_RATE / PROCESSES, chat_rate: float = CHAT_RATE,
+                 chat_burst: int = CHAT_BURST, senders: int = SENDERS):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}  # type: Dict[int, TokenBucket]
+        self.senders = senders
+        self._start()
+        # threads do not survive a fork, a forked worker process starts its own (see sharding)
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self.lock = threading.Condition()
+        self.pending = {}  # type: Dict[int, Deque[_Message]]
+        # (due time, sequence, chat_id) of the chats whose first message waits to be sent; a chat
+        # is in it at most once and not while one of its messages is being sent
+        self.due = []  # type: List[Tuple[float, int, int]]
+        self.sequence = itertools.count()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._run, name='outbox-{}'.format(i), daemon=True)
+                        for i in range(self.senders)]
+        for thread in self.threads:
+            thread.start()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id: int, at: float):
+        heapq.heappush(self.due, (at, next(self.sequence), chat_id))
+        self.lock.notify()
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        with self.lock:
+            if self.closed:
+                raise ValueError('send to a closed outbox')
+            messages = self.pending.get(chat_id)
+            if messages is None:
+                messages = self.pending[chat_id] = collections.deque()
+                self._schedule(chat_id, time.monotonic())
+            messages.append(_Message(text, kwargs))
+
+    def _next_chat(self) -> Optional[int]:
+        with self.lock:
+            while True:
+                if self.due:
+                    wait = self.due[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self.due)[2]
+                elif self.closed and not self.pending:
+                    return None
+                else:
+                    wait = None
+                self.lock.wait(wait)
+
+    def _run(self):
+        while True:
+            chat_id = self._next_chat()
+            if chat_id is None:
+                return
+            with self.lock:
+                message = self.pending[chat_id][0]
+                if not message.reserved:
+                    message.reserved = True
+                    wait = max(self._chat_bucket(chat_id).reserve(), self.bucket.reserve())
+                    if wait > 0:
+                        self._schedule(chat_id, time.monotonic() + wait)
+                        continue
+            at = time.monotonic()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=message.text, **message.kwargs)
+            except RetryAfter as e:
+                message.attempt += 1
+                if message.attempt < RETRIES:
+                    print('chat {}: rate limited, retrying in {}s'.format(chat_id, e.retry_after))
+                    with self.lock:
+                        message.reserved = False
+                        self.bucket.pause(e.retry_after)
+                        self._chat_bucket(chat_id).pause(e.retry_after)
+                        self._schedule(chat_id, time.monotonic() + e.retry_after)
+                    continue
+                print('chat {}: message dropped after {} rate limits'.format(chat_id, RETRIES))
+            except Exception as e:
+                print('chat {}: failed to send message: {!r}'.format(chat_id, e))
+            with self.lock:
+                messages = self.pending[chat_id]
+                messages.popleft()
+                if messages:
+                    self._schedule(chat_id, at)
+                else:
+                    del self.pending[chat_id]
+                    self.lock.notify_all()
+
+    def close(self):
+        """Sends the queued messages and stops the sender threads."""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+def with_progress(message: str, questions_asked: int, every: int = 10) -> str:
+    """Prepends the answered-questions note to every `every`-th item instead of sending it separately."""
+    if questions_asked > 0 and questions_asked % every == 0:
+        return '<i>Вы ответили на {} вопросов</i>\n\n{}'.format(questions_asked, message)
+    return message
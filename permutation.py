@@ -0,0 +1,84 @@
+import hashlib
+import random
+from collections.abc import Iterator
+from typing import Optional, Sequence, Tuple
+
+# Per-chat item order without copying the dataset: a keyed Feistel network is a
+# bijection on [0, 4^k), and cycle walking (re-encrypting until the value falls
+# below n) restricts it to a bijection on [0, n). A session is then fully
+# described by (seed, position) and can be resumed from it at any time.
+
+ROUNDS = 4
+
+
+class FeistelPermutation(Sequence):
+    """Pseudo-random permutation of range(n) determined by `seed`."""
+
+    def __init__(self, n: int, seed: int, rounds: int = ROUNDS):
+        self.n = n
+        self.seed = seed
+        self.rounds = rounds
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.key = seed.to_bytes(16, 'little', signed=True)
+
+    def _round(self, i: int, value: int) -> int:
+        digest = hashlib.blake2b(value.to_bytes(8, 'little'), digest_size=8, key=self.key,
+                                 salt=i.to_bytes(16, 'little')).digest()
+        return int.from_bytes(digest, 'little') & self.mask
+
+    def _encrypt(self, x: int) -> int:
+        left, right = x >> self.half_bits, x & self.mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half_bits) | right
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, position: int) -> int:
+        if position < 0:
+            position += self.n
+        if not 0 <= position < self.n:
+            raise IndexError(position)
+        # the domain is less than 4n, so this takes a few steps on average
+        x = self._encrypt(position)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+
+class ShuffledItems(Iterator):
+    """Yields `(position, item)` over `items` in a per-session pseudo-random order.
+
+    With `repeat` the items are served again in a fresh order after every pass, like
+    reshuffling a copy of the list. The state is just `(seed, position)`.
+    """
+
+    def __init__(self, items: Sequence, seed: Optional[int] = None, position: int = 0, repeat: bool = False):
+        self.items = items
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.position = position
+        self.repeat = repeat
+        self._epoch = None
+        self._order = None  # type: Optional[FeistelPermutation]
+
+    @property
+    def state(self) -> Tuple[int, int]:
+        return self.seed, self.position
+
+    def _permutation(self, epoch: int) -> FeistelPermutation:
+        if epoch != self._epoch:
+            self._epoch = epoch
+            self._order = FeistelPermutation(len(self.items), self.seed if epoch == 0 else hash((self.seed, epoch)))
+        return self._order
+
+    def __next__(self):
+        n = len(self.items)
+        epoch, offset = divmod(self.position, n) if n else (0, 0)
+        if n == 0 or (epoch > 0 and not self.repeat):
+            raise StopIteration
+        item = self.items[self._permutation(epoch)[offset]]
+        position = self.position
+        self.position += 1
+        return position, item
@@ -0,0 +1,106 @@
+import functools
+import time
+from collections.abc import Iterator, Sized
+from typing import Any, Callable, List, Optional
+
+# Dataset preparation as a chain of stages.
+#
+# Streaming stages take an iterable and may return a lazy iterator, blocking
+# stages need the whole input and get it as a list. Intermediate results are
+# only materialized in front of a blocking stage that does not already get a
+# list, so a chain like `numerate_ids(balance_operators(mixin_random_answers(...)))`
+# no longer copies the dataset in every stage.
+
+
+class Stage:
+    def __init__(self, fn: Callable, blocking: bool = False, name: Optional[str] = None):
+        functools.update_wrapper(self, fn)
+        self.fn = fn
+        self.blocking = blocking
+        self.name = name or fn.__name__
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+
+def streaming(fn: Callable) -> Stage:
+    return fn if isinstance(fn, Stage) else Stage(fn)
+
+
+def blocking(fn: Callable) -> Stage:
+    return Stage(fn, blocking=True)
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = None  # type: Optional[int]
+        self.seconds = 0.0
+        # lazy upstream stage whose rows are pulled (and timed) while this stage runs
+        self.upstream = None  # type: Optional[StageStats]
+
+    @property
+    def own_seconds(self) -> float:
+        return max(self.seconds - (self.upstream.seconds if self.upstream is not None else 0.0), 0.0)
+
+
+class _Meter(Iterator):
+    def __init__(self, iterable, stats: StageStats, on_exhausted: Optional[Callable[[], None]] = None):
+        self.iterator = iter(iterable)
+        self.stats = stats
+        self.stats.rows = 0
+        self.on_exhausted = on_exhausted
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        except StopIteration:
+            self.stats.seconds += time.perf_counter() - started
+            if self.on_exhausted is not None:
+                self.on_exhausted()
+                self.on_exhausted = None
+            raise
+        self.stats.seconds += time.perf_counter() - started
+        self.stats.rows += 1
+        return item
+
+
+class Pipeline:
+    """`Pipeline(a, b, c).run(*args)` computes `c(b(a(*args)))` and prints per-stage row counts and timings
+    once the result has been consumed."""
+
+    def __init__(self, *stages: Callable, name: str = 'pipeline'):
+        self.stages = [streaming(stage) for stage in stages]
+        self.name = name
+
+    def run(self, *args) -> Any:
+        stats = []
+        data = None
+        for i, stage in enumerate(self.stages):
+            stage_stats = StageStats(stage.name)
+            if stage.blocking and i > 0 and not isinstance(data, list):
+                data = list(data)
+            if isinstance(data, _Meter):
+                stage_stats.upstream = data.stats
+
+            started = time.perf_counter()
+            data = stage(*args) if i == 0 else stage(data)
+            stage_stats.seconds = time.perf_counter() - started
+
+            if not isinstance(data, Iterator):
+                stage_stats.rows = len(data) if isinstance(data, Sized) else None
+            elif i < len(self.stages) - 1:
+                data = _Meter(data, stage_stats)
+            else:
+                data = _Meter(data, stage_stats, lambda: self.report(stats))
+            stats.append(stage_stats)
+
+        if not isinstance(data, _Meter):
+            self.report(stats)
+        return data
+
+    def report(self, stats: List[StageStats]):
+        print('{}:'.format(self.name))
+        for s in stats:
+            print('  {:<28} {:>10} rows {:>9.3f}s'.format(s.name, '?' if s.rows is None else s.rows, s.own_seconds))
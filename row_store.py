@@ -0,0 +1,168 @@
+import random
+from array import array
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence
+
+
+class StringPool(Sequence):
+    """Interned strings addressed by a dense integer code."""
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}  # type: Dict[str, int]
+
+    def intern(self, s: str) -> int:
+        code = self.codes.get(s)
+        if code is None:
+            code = self.codes[s] = len(self.strings)
+            self.strings.append(s)
+        return code
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+
+class RowsView(Sequence):
+    def __init__(self, store: 'RowStore', positions: Sequence[int]):
+        self.store = store
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.store.row(p) for p in self.positions[i]]
+        return self.store.row(self.positions[i])
+
+
+class OperatorIndex:
+    """Row positions of one context by operator code, with the position of the highest discriminator
+    of every operator."""
+
+    __slots__ = ('positions', 'best')
+
+    def __init__(self):
+        self.positions = {}  # type: Dict[int, array]
+        self.best = {}  # type: Dict[int, int]
+
+
+class RowStore(Mapping):
+    """Array-backed `context -> rows` mapping.
+
+    Contexts, questions, answers and operators are interned once and rows only keep
+    their codes; `Row` tuples are built when a row is accessed. Rows are also indexed by
+    context and operator as they are appended, and the answers of every operator are pooled
+    for random draws.
+    """
+
+    def __init__(self, row_type):
+        assert tuple(row_type._fields) == ('id', 'context', 'question', 'answer', 'operator', 'discriminator'), \
+            row_type._fields
+        self.row_type = row_type
+        self.contexts = StringPool()
+        self.questions = StringPool()
+        self.answers = StringPool()
+        self.operators = StringPool()
+
+        self.ids = array('q')
+        self.context_codes = array('I')
+        self.question_codes = array('I')
+        self.answer_codes = array('I')
+        self.operator_codes = array('B')
+        self.discriminators = array('d')
+        self.groups = []  # type: List[array]
+        self.operator_index = []  # type: List[OperatorIndex]
+        self.answer_pools = {}  # type: Dict[int, array]
+
+    def append(self, row_id: int, context: str, question: str, answer: str, operator: str, discriminator: float):
+        position = self.n_rows
+        context_code = self.contexts.intern(context)
+        if context_code == len(self.groups):
+            self.groups.append(array('I'))
+            self.operator_index.append(OperatorIndex())
+        self.groups[context_code].append(position)
+
+        answer_code = self.answers.intern(answer)
+        operator_code = self.operators.intern(operator)
+        index = self.operator_index[context_code]
+        positions = index.positions.get(operator_code)
+        if positions is None:
+            positions = index.positions[operator_code] = array('I')
+            index.best[operator_code] = position
+        elif discriminator > self.discriminators[index.best[operator_code]]:
+            # strictly greater keeps the first of equal rows, same as max()
+            index.best[operator_code] = position
+        positions.append(position)
+        self.answer_pools.setdefault(operator_code, array('I')).append(answer_code)
+
+        self.ids.append(row_id)
+        self.context_codes.append(context_code)
+        self.question_codes.append(self.questions.intern(question))
+        self.answer_codes.append(answer_code)
+        self.operator_codes.append(operator_code)
+        self.discriminators.append(discriminator)
+
+    def extend(self, rows: Iterable[tuple]):
+        for row in rows:
+            self.append(*row)
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.ids)
+
+    def row(self, position: int):
+        return self.row_type(self.ids[position],
+                             self.contexts[self.context_codes[position]],
+                             self.questions[self.question_codes[position]],
+                             self.answers[self.answer_codes[position]],
+                             self.operators[self.operator_codes[position]],
+                             self.discriminators[position])
+
+    def operator_positions(self, context_code: int, *operators: str) -> Sequence[int]:
+        """Positions of the rows of a context that have one of `operators`, in insertion order."""
+        index = self.operator_index[context_code]
+        groups = [index.positions[code] for code in map(self.operators.codes.get, operators)
+                  if code in index.positions]
+        if len(groups) <= 1:
+            return groups[0] if groups else ()
+        return sorted(chain.from_iterable(groups))
+
+    def best_position(self, context_code: int, *operators: str) -> Optional[int]:
+        """Position of the first row with the highest discriminator among the rows of a context
+        that have one of `operators`."""
+        index = self.operator_index[context_code]
+        best = None
+        for position in sorted(index.best[code] for code in map(self.operators.codes.get, operators)
+                               if code in index.best):
+            if best is None or self.discriminators[position] > self.discriminators[best]:
+                best = position
+        return best
+
+    def random_answer(self, operator: str) -> str:
+        """An answer drawn from all rows of `operator`, so frequent answers come up more often."""
+        return self.answers[random.choice(self.answer_pools[self.operators.codes[operator]])]
+
+    def rows(self) -> RowsView:
+        return RowsView(self, range(self.n_rows))
+
+    def __getitem__(self, context: str) -> RowsView:
+        code = self.contexts.codes.get(context)
+        if code is None:
+            raise KeyError(context)
+        return RowsView(self, self.groups[code])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.contexts.strings)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def values(self):
+        return [RowsView(self, positions) for positions in self.groups]
+
+    def items(self):
+        return list(zip(self.contexts.strings, self.values()))
@@ -1,75 +1,77 @@
-import csv
+import html
 import random
-from datetime import datetime
-from itertools import chain
-from typing import List, Tuple, Dict
 import re
+from datetime import datetime
+from typing import List, Tuple, Optional
 
 import os
-from collections import namedtuple, defaultdict
+from collections import namedtuple, Counter
 
-import pickle
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
 
+from annotation_store import open_sink
+from callback_token import CALLBACK_SECRET, CallbackSigner
+from balance import balance_index, operator_codes
+from dataset_cache import load_or_update
+from ingest import ingest_dialogs
+from keyboard import KeyboardTemplate
+from lanes import CHAT_WORKERS, ChatLanes
+from markup import TEXT_FIRST
+from outbox import Outbox, with_progress
+from permutation import ShuffledItems
+from pipeline import Pipeline, blocking
+from row_store import RowStore
+from scheduler import SCHEDULER, ScheduledItems, ThompsonScheduler
+from sequential import OpenItems, SequentialTests
+from serving import serve
+from session_store import SessionStore
+from tallies import Tallies, is_admin
+
 
 INPUT_FILE = 'downloads/test_predict_243k_balanced_2911_0.csv'
-CACHE_FILE = INPUT_FILE + '2var.pickle'
+CACHE_FILE = INPUT_FILE + '2var.rows'
 OUTPUT_FILE = 'target/test_predict_243k_balanced_2911_0_{}.tsv'.format(datetime.now().strftime('%Y%m%dT%H%M%S'))
+SESSIONS_FILE = 'target/test_predict_243k_balanced_2911_0_2variants.sessions'
+ANNOTATIONS_FILE = 'target/test_predict_243k_balanced_2911_0_2variants.annotations'
+ANSWERED_FILE = 'target/test_predict_243k_balanced_2911_0_2variants.answered'
+DECISIONS_FILE = 'target/test_predict_243k_balanced_2911_0_2variants.decisions'
 TOKEN = os.environ['SENSE_BOT_TOKEN']
+INGEST_WORKERS = int(os.environ.get('SENSE_BOT_INGEST_WORKERS', os.cpu_count()))
 OPERATOR_RANDOM = 'random'
 OPERATOR_HUMAN = 'human'
 OPERATOR_BOT = 'bot'
 OPERATOR_BOT_BEST = 'botbest'
 OPERATORS = [OPERATOR_BOT, OPERATOR_BOT_BEST]
+# operator pairs the live tallies test and the scheduler compares
+PAIRS = [(OPERATOR_BOT, OPERATOR_BOT_BEST)]
+CACHE_PARAMS = {'pipeline': ['prepare_dataset', 'get_best_and_random_answer', 'balance_and_shuffle', 'numerate_ids'],
+                'operators': OPERATORS, 'rendered': {'message': 2}}
 
 Row = namedtuple('Row', 'id context question answer operator discriminator')
 
 
-def prepare_dataset(filename=INPUT_FILE) -> Dict[str, List[Row]]:
-    contexts = defaultdict(list)
-    with open(filename) as f:
-        csvfile = csv.reader(f, delimiter=',')
-        next(csvfile)
-        index = 0
-        while True:
-            try:
-                text, is_human, discriminator_score = next(csvfile)
-                context, *_ = text.split(' <ANS_START> ')
-                chunks = re.findall(r'(<[A-Z_]+> [^<>]*)', text)
-                answer = chunks[-1]
-
-                assert answer.startswith('<ANS_START> '), text
-                answer = answer.replace('<ANS_START> ', '')
-
-                if chunks[-2].startswith('<MAN_START> '):
-                    continue
-                if chunks[-2].startswith('<PAUSE> '):
-                    continue
-
-                assert chunks[-2].startswith('<COR_START> '), [chunks[-2], text]
-                question = chunks[-2].replace('<COR_START> ', '')
-
-                if ('здравствуйте' in answer.lower()) and ('cлужба технической поддержки' in answer.lower()):
-                    print(answer)
-                    continue
-
-                if int(is_human):
-                    continue
-
-                row = Row(index, context, question, answer, OPERATOR_BOT, float(discriminator_score))
-
-                contexts[context].append(row)
-                index += 1
-            except StopIteration:
-                break
-            except IndexError:
-                pass
+def prepare_dataset(filename=INPUT_FILE, contexts: Optional[RowStore] = None,
+                    start: Optional[int] = None, end: Optional[int] = None) -> RowStore:
+    if contexts is None:
+        contexts = RowStore(Row)
+    skipped = Counter()
+    index = contexts.n_rows
+    dialogs = ingest_dialogs(filename, TEXT_FIRST, skipped, workers=INGEST_WORKERS, start=start, end=end)
+    for context, question, answer, is_human, discriminator_score in dialogs:
+        if int(is_human):
+            skipped['human'] += 1
+            continue
+
+        contexts.append(index, context, question, answer, OPERATOR_BOT, float(discriminator_score))
+        index += 1
+    print('skipped:', dict(skipped))
     return contexts
 
 
-def get_best_and_random_answer(dataset):
-    for context, rows in dataset.items():
+def get_best_and_random_answer(dataset, contexts=None):
+    selected = dataset.items() if contexts is None else [(c, dataset[c]) for c in contexts]
+    for context, rows in selected:
         rows = list(rows)
         if len(rows) == 1:
             continue
@@ -85,70 +87,83 @@ def get_best_and_random_answer(dataset):
         yield random_row
 
 
-def balance_and_shuffle(dataset):
-    dataset = list(dataset)
-    operatos_rows = [[r for r in dataset if r.operator == op] for op in OPERATORS]
-    dataset = list(chain(*zip(*operatos_rows)))
-    random.shuffle(dataset)
-    return dataset
+@blocking
+def balance_and_shuffle(dataset: List[Row]):
+    return [dataset[i] for i in balance_index(operator_codes(dataset, OPERATORS), len(OPERATORS))]
 
 
-def numerate_ids(dataset):
-    dataset = list(dataset)
+@blocking
+def numerate_ids(dataset: List[Row]):
     for op in OPERATORS:
         print(op, ':', len([1 for r in dataset if r.operator == op]))
     return {r.id: r for r in dataset}
 
 
-def prepare_message(instance: Tuple[int, Row]):
-    questions_asked, row = instance
-    message = row.question + '\n' + "<b>Ответ:</b>\n{}".format(row.answer)
+def sort_by_id(dataset):
+    return sorted(dataset.values())
 
-    t = datetime.now().isoformat()
 
-    button_list = [
-        [InlineKeyboardButton('Осмысленно', callback_data='{0};{r.id};{r.discriminator};{r.operator};1'.format(t, r=row)),
-         InlineKeyboardButton('Не осмысленно', callback_data='{0};{r.id};{r.discriminator};{r.operator};0'.format(t, r=row))]
+ARRANGE_PIPELINE = Pipeline(balance_and_shuffle, numerate_ids, sort_by_id, name='arrange')
 
-    ]
-    reply_markup = InlineKeyboardMarkup(button_list)
 
-    return questions_asked, message, reply_markup
+def render_message(row: Row) -> str:
+    question = re.sub(r'\d+', '<NUM>', row.question)
+    answer = re.sub(r'\d+', '<NUM>', row.answer)
+    return "{question}\n<b>Ответ:</b>\n{answer}".format(question=html.escape(question), answer=html.escape(answer))
 
 
-def main():
-    updater = Updater(token=TOKEN)
-    dispatcher = updater.dispatcher
+RENDERED = {'message': render_message}
+KEYBOARD = KeyboardTemplate([[('Осмысленно', '{};1'), ('Не осмысленно', '{};0')]])
+FINISHED_MESSAGE = 'Спасибо! Сбор оценок завершён.'
+EXPIRED_MESSAGE = 'Эта кнопка устарела, ответ не записан. Ответьте, пожалуйста, на следующий вопрос.'
 
-    dialogs = {}
 
-    exists = os.path.isfile(OUTPUT_FILE)
-    os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
+def prepare_message(signer: CallbackSigner, nonce: int, instance: Tuple[int, Row]):
+    questions_asked, row = instance
+    return questions_asked, row.message, KEYBOARD.render(signer.encode(row.id, nonce))
 
-    if not os.path.isfile(CACHE_FILE):
-        print('Creating cache file {} ...'.format(CACHE_FILE))
-        dataset = numerate_ids(balance_and_shuffle(get_best_and_random_answer(prepare_dataset(INPUT_FILE))))
-        with open(CACHE_FILE, 'wb') as f:
-            pickle.dump(dataset, f)
-        print('Created!')
 
-    with open(CACHE_FILE, 'rb') as f:
-        dataset = pickle.load(f)
+def main():
+    updater = Updater(token=TOKEN, request_kwargs={'con_pool_size': CHAT_WORKERS + 4})
+    dispatcher = updater.dispatcher
 
-    with open(OUTPUT_FILE, 'a', newline='') as tsvfile:
-        writer = csv.writer(tsvfile, delimiter='\t')
+    os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-        if not exists:
-            writer.writerow(['chat_id', 'user', 'question_id', 'context', 'operator', 'question', 'answer',
-                             'time_asked', 'time_answered', 'is_meaningful', 'discriminator_score'])
-            tsvfile.flush()
+    # rows are stored in id order so that they can be looked up by question_id
+    dataset = load_or_update(CACHE_FILE, INPUT_FILE, CACHE_PARAMS, Row, 'issssd',
+                             ingest=lambda store, start, end: prepare_dataset(INPUT_FILE, store, start, end),
+                             select=get_best_and_random_answer,
+                             arrange=lambda kept, rows: ARRANGE_PIPELINE.run(kept + list(rows)),
+                             lazy_text=True, rendered=RENDERED).by_id()
+    signer = CallbackSigner(CALLBACK_SECRET or TOKEN, dataset.table.build)
+
+    tallies = Tallies(OPERATORS, PAIRS)
+    tests = SequentialTests(tallies, DECISIONS_FILE)
+    scheduler = None
+    if SCHEDULER == 'thompson':
+        scheduler = ThompsonScheduler(tallies, dataset.values(), dataset.table.columns['operator'], tests=tests)
+
+    def shuffled(seed=None, position=0, pools=None, served=None):
+        if scheduler is not None:
+            return ScheduledItems(scheduler, seed, position, pools)
+        return OpenItems(ShuffledItems(dataset.values(), seed, position), tests, lambda row: row.operator,
+                         served=served)
+
+    # after the dataset is loaded: their threads restart in forked processes, which the ingest pool
+    # workers must not get
+    lanes = ChatLanes(dispatcher)
+    outbox = Outbox(updater.bot)
+    dialogs = SessionStore(SESSIONS_FILE, shuffled)
+
+    header = ['chat_id', 'user', 'question_id', 'context', 'operator', 'question', 'answer',
+              'time_asked', 'time_answered', 'is_meaningful', 'discriminator_score', 'item']
+    with open_sink(OUTPUT_FILE, header, store=ANNOTATIONS_FILE, seen=ANSWERED_FILE, tallies=tallies) as writer:
 
         def start(bot: Bot, update: Update):
             chat_id = update.message.chat_id
-            dataset_rows = list(dataset.values())
-            random.shuffle(dataset_rows)
             dialogs[chat_id] = {
-                'batch_generator': iter(enumerate(dataset_rows))
+                'batch_generator': shuffled(),
+                'nonce': random.getrandbits(32)
             }
 
             startup_message = '''Добрый день! Сейчас вам будут представлены фрагменты из чата оператора поддержки банка с клиентом. Просим вас оценить ответ оператора на вопрос клиента по степени осмысленности. Осмысленность понимайте как ваше субъективное ощущение того, что оператор понимает запрос клиента и пытается помочь.
@@ -156,42 +171,69 @@ def main():
 Каждые 10 фрагментов, система будет выводить количество оценённых ответов.
 '''
 
-            bot.send_message(chat_id=chat_id, text=startup_message)
+            outbox.send_message(chat_id=chat_id, text=startup_message)
 
-            i, message, reply_markup = prepare_message(next(dialogs[chat_id]['batch_generator']))
-            bot.send_message(chat_id=chat_id, text=message,
-                             reply_markup=reply_markup, parse_mode='HTML')
+            dialog = dialogs[chat_id]
+            instance = next(dialog['batch_generator'], None)
+            if instance is None:
+                outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                return
+            i, message, reply_markup = prepare_message(signer, dialog['nonce'], instance)
+            dialogs.save(chat_id)
+            outbox.send_message(chat_id=chat_id, text=message,
+                                reply_markup=reply_markup, parse_mode='HTML')
 
         def reply(bot: Bot, update: Update):
             query = update.callback_query
             chat_id = query.message.chat_id
             user = (update.effective_user.first_name or '') + '@' + (update.effective_user.username or '')
 
-            time_asked, question_id, score, operator, is_meaningful = query.data.split(';')
-            question_id = int(question_id)
-            question = dataset[question_id].question
-            answer = dataset[question_id].answer
-            context = dataset[question_id].context
-            writer.writerow([chat_id, user, question_id, context, operator, question, answer,
-                             time_asked, datetime.now().isoformat(), is_meaningful, score])
-            tsvfile.flush()
+            token, is_meaningful = query.data.split(';')
+            callback = signer.decode(token)
+            key = '{};{}'.format(chat_id, token)
+            if callback is None:
+                # e.g. a button sent before the dataset or the secret changed
+                print('chat {}: rejected callback token {!r} ({} so far)'.format(chat_id, token, signer.rejected))
+                outbox.send_message(chat_id=chat_id, text=EXPIRED_MESSAGE)
+            elif not writer.claim(key):
+                # a double tap or a redelivered callback: the answer is recorded and the next item sent
+                return
+            else:
+                row = dataset[callback.item]
+                writer.writerow([chat_id, user, row.id, row.context, row.operator, row.question, row.answer,
+                                 callback.time_asked, datetime.now().isoformat(), is_meaningful, row.discriminator,
+                                 callback.item],
+                                key=key,
+                                tally=[(row.operator, is_meaningful == '1', row.discriminator)])
 
             if chat_id not in dialogs:
                 start(bot, query)
             else:
-                i, message, reply_markup = prepare_message(next(dialogs[chat_id]['batch_generator']))
-                if i > 0 and i % 10 == 0:
-                    bot.send_message(chat_id=chat_id, text='<i>Вы ответили на {} вопросов</i>'.format(i),
-                                     parse_mode='HTML')
-                bot.send_message(chat_id=chat_id, text=message,
-                                 reply_markup=reply_markup, parse_mode='HTML')
-
-        dispatcher.add_handler(CommandHandler('start', start))
-        dispatcher.add_handler(CallbackQueryHandler(reply))
-
-        updater.start_polling()
-
-        updater.idle()
+                dialog = dialogs[chat_id]
+                instance = next(dialog['batch_generator'], None)
+                if instance is None:
+                    outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                    return
+                i, message, reply_markup = prepare_message(signer, dialog['nonce'], instance)
+                dialogs.save(chat_id)
+                outbox.send_message(chat_id=chat_id, text=with_progress(message, i),
+                                    reply_markup=reply_markup, parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('start', lanes.wrap(start)))
+        dispatcher.add_handler(CallbackQueryHandler(lanes.wrap(reply)))
+
+        def stats(bot: Bot, update: Update):
+            if is_admin(update.effective_user):
+                outbox.send_message(chat_id=update.message.chat_id, text=tests.report_html(), parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('stats', lanes.wrap(stats)))
+
+        serve(updater, report=tests.report)
+        lanes.close()
+        outbox.close()
+        dialogs.close()
+    # after the sink, whose writer takes the decisions
+    tests.close()
 
 
 if __name__ == '__main__':
@@ -1,24 +1,42 @@
-import csv
 import random
 from datetime import datetime
 from itertools import chain
-from typing import List, Tuple, Dict, Any
-import re
-import uuid
+from typing import List, Tuple, Optional
 
 import os
-from collections import namedtuple, defaultdict
+from collections import namedtuple, Counter
 
-import pickle
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
 
+from annotation_store import open_sink
+from callback_token import CALLBACK_SECRET, CallbackSigner
+from dataset_cache import RowTable, load_or_update
+from ingest import ingest_dialogs
+from keyboard import KeyboardTemplate
+from lanes import CHAT_WORKERS, ChatLanes
+from markup import TEXT_FIRST
+from outbox import Outbox, with_progress
+from permutation import ShuffledItems
+from pipeline import Pipeline, Stage, blocking
+from row_store import RowStore
+from scheduler import SCHEDULER, ScheduledItems, ThompsonScheduler
+from sequential import OpenItems, SequentialTests
+from serving import serve
+from session_store import SessionStore
+from tallies import Tallies, is_admin
+
 import html
 
 INPUT_FILE = 'downloads/test_predict_243k_balanced_2911_0.csv'
-CACHE_FILE = INPUT_FILE + '_4operators.pickle'
+CACHE_FILE = INPUT_FILE + '_4operators.rows'
 OUTPUT_FILE = 'target/test_predict_243k_balanced_2911_0__4operators_context_{}.tsv'.format(datetime.now().strftime('%Y%m%dT%H%M%S'))
+SESSIONS_FILE = 'target/test_predict_243k_balanced_2911_0__4operators_context.sessions'
+ANNOTATIONS_FILE = 'target/test_predict_243k_balanced_2911_0__4operators_context.annotations'
+ANSWERED_FILE = 'target/test_predict_243k_balanced_2911_0__4operators_context.answered'
+DECISIONS_FILE = 'target/test_predict_243k_balanced_2911_0__4operators_context.decisions'
 TOKEN = os.environ['SENSE_BOT_TOKEN']
+INGEST_WORKERS = int(os.environ.get('SENSE_BOT_INGEST_WORKERS', os.cpu_count()))
 OPERATOR_RANDOM = 'random'
 OPERATOR_HUMAN = 'human'
 OPERATOR_BOT_FIRST = 'botfirst'
@@ -27,153 +45,125 @@ OPERATOR_BOT_RETR = 'botretr'
 
 # TODO: add OPERATOR_BOT_RETR
 OPERATORS = [OPERATOR_HUMAN, OPERATOR_BOT_FIRST, OPERATOR_BOT_BEST, OPERATOR_RANDOM]
+# operator pairs the live tallies test and the scheduler compares
+PAIRS = [(OPERATOR_HUMAN, OPERATOR_BOT_FIRST), (OPERATOR_HUMAN, OPERATOR_BOT_BEST),
+         (OPERATOR_BOT_FIRST, OPERATOR_BOT_BEST)]
+CACHE_PARAMS = {'pipeline': ['prepare_dataset', 'get_best_and_random_answer', 'shuffle'], 'operators': OPERATORS,
+                'rendered': {'message': 1}}
 
 operators_map = {'0': OPERATOR_BOT_FIRST,
                  '1': OPERATOR_HUMAN,
                  '2': OPERATOR_BOT_RETR}
+BOT_OPERATORS = [op for op in operators_map.values() if op != OPERATOR_HUMAN]
 
 Row = namedtuple('Row', 'id context question answer operator discriminator')
 
 
-def prepare_dataset(filename=INPUT_FILE) -> Dict[str, List[Row]]:
-    contexts = defaultdict(list)
-    with open(filename) as f:
-        csvfile = csv.reader(f, delimiter=',')
-        next(csvfile)
-        index = 0
-        while True:
-            try:
-                text, is_human, discriminator_score = next(csvfile)
-                context, *_ = text.split(' <ANS_START> ')
-                chunks = re.findall(r'(<[A-Z_]+> [^<>]*)', text)
-                answer = chunks[-1]
-
-                assert answer.startswith('<ANS_START> '), text
-                answer = answer.replace('<ANS_START> ', '')
-
-                if chunks[-2].startswith('<MAN_START> '):
-                    continue
-                if chunks[-2].startswith('<PAUSE> '):
-                    continue
-
-                assert chunks[-2].startswith('<COR_START> '), [chunks[-2], text]
-                question = chunks[-2].replace('<COR_START> ', '')
-
-                if ('здравствуйте' in answer.lower()) and ('cлужба технической поддержки' in answer.lower()):
-                    print(answer)
-                    continue
-
-                operator = operators_map[is_human]
-
-                row = Row(index, context, question, answer, operator, float(discriminator_score))
-
-                contexts[context].append(row)
-                index += 1
-            except StopIteration:
-                break
-            except IndexError:
-                pass
+def prepare_dataset(filename=INPUT_FILE, contexts: Optional[RowStore] = None,
+                    start: Optional[int] = None, end: Optional[int] = None) -> RowStore:
+    if contexts is None:
+        contexts = RowStore(Row)
+    skipped = Counter()
+    for index, (context, question, answer, is_human, discriminator_score) in enumerate(
+            ingest_dialogs(filename, TEXT_FIRST, skipped, workers=INGEST_WORKERS, start=start, end=end),
+            contexts.n_rows):
+        contexts.append(index, context, question, answer, operators_map[is_human], float(discriminator_score))
+    print('skipped:', dict(skipped))
     return contexts
 
 
-def get_best_and_random_answer(dataset):
-    human_answers = []
-    for rows in dataset.values():
-        for r in rows:
-            if r.operator == OPERATOR_HUMAN:
-                human_answers.append(r.answer)
-
-    for context, rows in dataset.items():
-        rows = list(rows)
-        if len(rows) == 1:
+def get_best_and_random_answer(dataset: RowStore, contexts=None):
+    codes = range(len(dataset)) if contexts is None else [dataset.contexts.codes[c] for c in contexts]
+    for code in codes:
+        if len(dataset.groups[code]) == 1:
             continue
 
-        human_rows = [r for r in rows if r.operator == OPERATOR_HUMAN]
+        human_rows = dataset.operator_positions(code, OPERATOR_HUMAN)
         if not human_rows:
             continue
-        bot_rows = [r for r in rows if r.operator != OPERATOR_HUMAN]
+        bot_rows = dataset.operator_positions(code, *BOT_OPERATORS)
 
         if not bot_rows:
             continue
 
-        best_row = max(bot_rows, key=lambda x: x.discriminator)
-        values = dict(zip(Row._fields, best_row))
-        values['operator'] = OPERATOR_BOT_BEST
-        best_row = Row(**values)
+        best_row = dataset.row(dataset.best_position(code, *BOT_OPERATORS))._replace(operator=OPERATOR_BOT_BEST)
 
-        first_row = bot_rows[0]
+        first_row = dataset.row(bot_rows[0])
 
-        values = dict(zip(Row._fields, random.choice(bot_rows)))
-        values['operator'] = OPERATOR_RANDOM
-        values['answer'] = random.choice(human_answers)
-        random_row = Row(**values)
+        random_row = dataset.row(random.choice(bot_rows))._replace(operator=OPERATOR_RANDOM,
+                                                                   answer=dataset.random_answer(OPERATOR_HUMAN))
 
         #TODO: add botretr here
-        yield human_rows[0], best_row, first_row, random_row
+        yield dataset.row(human_rows[0]), best_row, first_row, random_row
 
 
-def shuffle(dataset):
-    dataset = list(chain(*dataset))
+@blocking
+def shuffle(dataset: List[Row]):
     random.shuffle(dataset)
     return dataset
 
 
-def prepare_message(message_store: Dict[str, Any], instance: Tuple[int, Row]):
-    questions_asked, row = instance
+SELECT_PIPELINE = Pipeline(get_best_and_random_answer, Stage(chain.from_iterable, name='flatten'), shuffle,
+                           name='select')
 
-    # message = "{row.question}\n<b>Ответ:</b>\n{row.answer}".format(row=row)
-    message = "{question}\n<b>Ответ:</b>\n{answer}".format(question=html.escape(row.context), answer=row.answer)
 
-    time_asked = datetime.now().isoformat()
+def render_message(row: Row) -> str:
+    # message = "{row.question}\n<b>Ответ:</b>\n{row.answer}".format(row=row)
+    return "{question}\n<b>Ответ:</b>\n{answer}".format(question=html.escape(row.context), answer=row.answer)
 
-    uid = uuid.uuid1().hex
 
-    message_store[uid] = {'row': row, 'time_asked': time_asked}
+RENDERED = {'message': render_message}
+KEYBOARD = KeyboardTemplate([[('Осмысленно', '{};1'), ('Не осмысленно', '{};0')]])
+FINISHED_MESSAGE = 'Спасибо! Сбор оценок завершён.'
+EXPIRED_MESSAGE = 'Эта кнопка устарела, ответ не записан. Ответьте, пожалуйста, на следующий вопрос.'
 
-    button_list = [
-        [InlineKeyboardButton('Осмысленно', callback_data='{};1'.format(uid)),
-         InlineKeyboardButton('Не осмысленно', callback_data='{};0'.format(uid))],
-    ]
-    reply_markup = InlineKeyboardMarkup(button_list)
 
-    return questions_asked, message, reply_markup
+def prepare_message(signer: CallbackSigner, nonce: int, dataset: RowTable, instance: Tuple[int, int]):
+    questions_asked, position = instance
+    return questions_asked, dataset[position].message, KEYBOARD.render(signer.encode(position, nonce))
 
 
 def main():
-    updater = Updater(token=TOKEN)
+    updater = Updater(token=TOKEN, request_kwargs={'con_pool_size': CHAT_WORKERS + 4})
     dispatcher = updater.dispatcher
 
-    dialogs = {}
-
-    exists = os.path.isfile(OUTPUT_FILE)
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-    messages_store = {}
-
-    if not os.path.isfile(CACHE_FILE):
-        print('Creating cache file {} ...'.format(CACHE_FILE))
-        dataset = shuffle(get_best_and_random_answer(prepare_dataset(INPUT_FILE)))
-        with open(CACHE_FILE, 'wb') as f:
-            pickle.dump(dataset, f)
-        print('Created!')
-
-    with open(CACHE_FILE, 'rb') as f:
-        dataset = pickle.load(f)
-
-    with open(OUTPUT_FILE, 'a', newline='', encoding='utf-8') as tsvfile:
-        writer = csv.writer(tsvfile, delimiter='\t')
-
-        if not exists:
-            writer.writerow(['chat_id', 'user', 'is_meaningful', 'operator', 'question', 'answer', 'context',
-                             'discriminator', 'time_asked', 'time_answered'])
-            tsvfile.flush()
+    dataset = load_or_update(CACHE_FILE, INPUT_FILE, CACHE_PARAMS, Row, 'issssd',
+                             ingest=lambda store, start, end: prepare_dataset(INPUT_FILE, store, start, end),
+                             select=SELECT_PIPELINE.run,
+                             arrange=lambda kept, rows: kept + rows,
+                             lazy_text=True, rendered=RENDERED)
+    signer = CallbackSigner(CALLBACK_SECRET or TOKEN, dataset.build)
+
+    tallies = Tallies(OPERATORS + [OPERATOR_BOT_RETR], PAIRS)
+    tests = SequentialTests(tallies, DECISIONS_FILE)
+    scheduler = None
+    if SCHEDULER == 'thompson':
+        scheduler = ThompsonScheduler(tallies, range(len(dataset)), dataset.columns['operator'], tests=tests)
+
+    def shuffled(seed=None, position=0, pools=None, served=None):
+        if scheduler is not None:
+            return ScheduledItems(scheduler, seed, position, pools)
+        return OpenItems(ShuffledItems(range(len(dataset)), seed, position), tests,
+                         lambda item: dataset[item].operator, served=served)
+
+    # after the dataset is loaded: their threads restart in forked processes, which the ingest pool
+    # workers must not get
+    lanes = ChatLanes(dispatcher)
+    outbox = Outbox(updater.bot)
+    dialogs = SessionStore(SESSIONS_FILE, shuffled)
+
+    header = ['chat_id', 'user', 'is_meaningful', 'operator', 'question', 'answer', 'context',
+              'discriminator', 'time_asked', 'time_answered', 'item']
+    with open_sink(OUTPUT_FILE, header, encoding='utf-8', store=ANNOTATIONS_FILE, seen=ANSWERED_FILE,
+                   tallies=tallies) as writer:
 
         def start(bot: Bot, update: Update):
             chat_id = update.message.chat_id
-            dataset_rows = list(dataset)
-            random.shuffle(dataset_rows)
             dialogs[chat_id] = {
-                'batch_generator': iter(enumerate(dataset_rows))
+                'batch_generator': shuffled(),
+                'nonce': random.getrandbits(32)
             }
 
             startup_message = '''Добрый день! Сейчас вам будут представлены фрагменты из чата оператора поддержки банка с клиентом. Просим вас оценить ответ оператора на вопрос клиента по степени осмысленности. Осмысленность понимайте как ваше субъективное ощущение того, что оператор понимает запрос клиента и пытается помочь.
@@ -181,43 +171,71 @@ def main():
 Каждые 10 фрагментов, система будет выводить количество оценённых ответов.
 '''
 
-            bot.send_message(chat_id=chat_id, text=startup_message)
+            outbox.send_message(chat_id=chat_id, text=startup_message)
 
-            i, message, reply_markup = prepare_message(messages_store, next(dialogs[chat_id]['batch_generator']))
-            bot.send_message(chat_id=chat_id, text=message,
-                             reply_markup=reply_markup, parse_mode='HTML')
+            dialog = dialogs[chat_id]
+            instance = next(dialog['batch_generator'], None)
+            if instance is None:
+                outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                return
+            i, message, reply_markup = prepare_message(signer, dialog['nonce'], dataset, instance)
+            dialogs.save(chat_id)
+            outbox.send_message(chat_id=chat_id, text=message,
+                                reply_markup=reply_markup, parse_mode='HTML')
 
         def reply(bot: Bot, update: Update):
             query = update.callback_query
             chat_id = query.message.chat_id
             user = (update.effective_user.first_name or '') + '@' + (update.effective_user.username or '')
 
-            uid, result = query.data.split(';')
-            if uid in messages_store:
-                row = messages_store[uid]['row']
-                time_asked = messages_store[uid]['time_asked']
+            token, result = query.data.split(';')
+            callback = signer.decode(token)
+            key = '{};{}'.format(chat_id, token)
+            if callback is None:
+                # e.g. a button sent before the dataset or the secret changed
+                print('chat {}: rejected callback token {!r} ({} so far)'.format(chat_id, token, signer.rejected))
+                outbox.send_message(chat_id=chat_id, text=EXPIRED_MESSAGE)
+            elif not writer.claim(key):
+                # a double tap or a redelivered callback: the answer is recorded and the next item sent
+                return
+            else:
+                row = dataset[callback.item]
 
                 writer.writerow([chat_id, user, result, row.operator, row.question, row.answer,
-                                 row.context, row.discriminator, time_asked, datetime.now().isoformat()])
-                tsvfile.flush()
+                                 row.context, row.discriminator, callback.time_asked, datetime.now().isoformat(),
+                                 callback.item],
+                                key=key,
+                                tally=[(row.operator, result == '1', row.discriminator)])
                 # bot.send_message(chat_id=chat_id, text=row.operator)
 
             if chat_id not in dialogs:
                 start(bot, query)
             else:
-                i, message, reply_markup = prepare_message(messages_store, next(dialogs[chat_id]['batch_generator']))
-                if i > 0 and i % 10 == 0:
-                    bot.send_message(chat_id=chat_id, text='<i>Вы ответили на {} вопросов</i>'.format(i),
-                                     parse_mode='HTML')
-                bot.send_message(chat_id=chat_id, text=message,
-                                 reply_markup=reply_markup, parse_mode='HTML')
-
-        dispatcher.add_handler(CommandHandler('start', start))
-        dispatcher.add_handler(CallbackQueryHandler(reply))
-
-        updater.start_polling()
-
-        updater.idle()
+                dialog = dialogs[chat_id]
+                instance = next(dialog['batch_generator'], None)
+                if instance is None:
+                    outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                    return
+                i, message, reply_markup = prepare_message(signer, dialog['nonce'], dataset, instance)
+                dialogs.save(chat_id)
+                outbox.send_message(chat_id=chat_id, text=with_progress(message, i),
+                                    reply_markup=reply_markup, parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('start', lanes.wrap(start)))
+        dispatcher.add_handler(CallbackQueryHandler(lanes.wrap(reply)))
+
+        def stats(bot: Bot, update: Update):
+            if is_admin(update.effective_user):
+                outbox.send_message(chat_id=update.message.chat_id, text=tests.report_html(), parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('stats', lanes.wrap(stats)))
+
+        serve(updater, report=tests.report)
+        lanes.close()
+        outbox.close()
+        dialogs.close()
+    # after the sink, whose writer takes the decisions
+    tests.close()
 
 
 if __name__ == '__main__':
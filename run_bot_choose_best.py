@@ -1,75 +1,70 @@
-import csv
 import random
 from datetime import datetime
 from itertools import chain
-from typing import List, Tuple, Dict, Any
-import re
-import uuid
+from typing import List, Tuple, Optional
 
 import os
-from collections import namedtuple, defaultdict
+from collections import namedtuple, Counter
 
-import pickle
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler
 
+from annotation_store import open_sink
+from callback_token import CALLBACK_SECRET, CallbackSigner
+from dataset_cache import load_or_update, RowGroups
+from ingest import ingest_dialogs
+from keyboard import KeyboardTemplate
+from lanes import CHAT_WORKERS, ChatLanes
+from markup import TEXT_FIRST
+from outbox import Outbox, with_progress
+from permutation import ShuffledItems
+from pipeline import Pipeline, Stage, blocking
+from row_store import RowStore
+from sequential import OpenItems, SequentialTests
+from serving import serve
+from session_store import SessionStore
+from tallies import Tallies, is_admin
+
 INPUT_FILE = 'downloads/test_predict_243k_balanced_2911_0.csv'
-CACHE_FILE = INPUT_FILE + '_pickbest.pickle'
+CACHE_FILE = INPUT_FILE + '_pickbest.rows'
 OUTPUT_FILE = 'target/test_predict_243k_balanced_2911_0_{}.tsv'.format(datetime.now().strftime('%Y%m%dT%H%M%S'))
+SESSIONS_FILE = 'target/test_predict_243k_balanced_2911_0_pickbest.sessions'
+ANNOTATIONS_FILE = 'target/test_predict_243k_balanced_2911_0_pickbest.annotations'
+ANSWERED_FILE = 'target/test_predict_243k_balanced_2911_0_pickbest.answered'
+DECISIONS_FILE = 'target/test_predict_243k_balanced_2911_0_pickbest.decisions'
 TOKEN = os.environ['SENSE_BOT_TOKEN']
+INGEST_WORKERS = int(os.environ.get('SENSE_BOT_INGEST_WORKERS', os.cpu_count()))
 OPERATOR_RANDOM = 'random'
 OPERATOR_HUMAN = 'human'
 OPERATOR_BOT = 'bot'
 OPERATOR_BOT_BEST = 'botbest'
 OPERATORS = [OPERATOR_BOT, OPERATOR_BOT_BEST]
+CACHE_PARAMS = {'pipeline': ['prepare_dataset', 'get_best_and_random_answer', 'shuffle'], 'operators': OPERATORS}
 
 Row = namedtuple('Row', 'id context question answer operator discriminator')
 
 
-def prepare_dataset(filename=INPUT_FILE) -> Dict[str, List[Row]]:
-    contexts = defaultdict(list)
-    with open(filename) as f:
-        csvfile = csv.reader(f, delimiter=',')
-        next(csvfile)
-        index = 0
-        while True:
-            try:
-                text, is_human, discriminator_score = next(csvfile)
-                context, *_ = text.split(' <ANS_START> ')
-                chunks = re.findall(r'(<[A-Z_]+> [^<>]*)', text)
-                answer = chunks[-1]
-
-                assert answer.startswith('<ANS_START> '), text
-                answer = answer.replace('<ANS_START> ', '')
-
-                if chunks[-2].startswith('<MAN_START> '):
-                    continue
-                if chunks[-2].startswith('<PAUSE> '):
-                    continue
-
-                assert chunks[-2].startswith('<COR_START> '), [chunks[-2], text]
-                question = chunks[-2].replace('<COR_START> ', '')
-
-                if ('здравствуйте' in answer.lower()) and ('cлужба технической поддержки' in answer.lower()):
-                    print(answer)
-                    continue
-
-                if int(is_human):
-                    continue
-
-                row = Row(index, context, question, answer, OPERATOR_BOT, float(discriminator_score))
-
-                contexts[context].append(row)
-                index += 1
-            except StopIteration:
-                break
-            except IndexError:
-                pass
+def prepare_dataset(filename=INPUT_FILE, contexts: Optional[RowStore] = None,
+                    start: Optional[int] = None, end: Optional[int] = None) -> RowStore:
+    if contexts is None:
+        contexts = RowStore(Row)
+    skipped = Counter()
+    index = contexts.n_rows
+    dialogs = ingest_dialogs(filename, TEXT_FIRST, skipped, workers=INGEST_WORKERS, start=start, end=end)
+    for context, question, answer, is_human, discriminator_score in dialogs:
+        if int(is_human):
+            skipped['human'] += 1
+            continue
+
+        contexts.append(index, context, question, answer, OPERATOR_BOT, float(discriminator_score))
+        index += 1
+    print('skipped:', dict(skipped))
     return contexts
 
 
-def get_best_and_random_answer(dataset):
-    for context, rows in dataset.items():
+def get_best_and_random_answer(dataset, contexts=None):
+    selected = dataset.items() if contexts is None else [(c, dataset[c]) for c in contexts]
+    for context, rows in selected:
         rows = list(rows)
         if len(rows) == 1:
             continue
@@ -85,14 +80,26 @@ def get_best_and_random_answer(dataset):
             yield best_row, random_row
 
 
-def shuffle(dataset):
-    dataset = list(dataset)
+@blocking
+def shuffle(dataset: List[Tuple[Row, Row]]):
     random.shuffle(dataset)
     return dataset
 
 
-def prepare_message(message_store: Dict[str, Any], instance: Tuple[int, Tuple[Row, Row]]):
-    questions_asked, [best_row, random_row] = instance
+SELECT_PIPELINE = Pipeline(get_best_and_random_answer, shuffle, Stage(chain.from_iterable, name='flatten'),
+                           name='select')
+
+
+KEYBOARD = KeyboardTemplate([[('Ответ А', '{};a'), ('Ответ Б', '{};b')], [('Нет разницы', '{};equal')]])
+FINISHED_MESSAGE = 'Спасибо! Сбор оценок завершён.'
+EXPIRED_MESSAGE = 'Эта кнопка устарела, ответ не записан. Ответьте, пожалуйста, на следующий вопрос.'
+# answers shown as А and Б for the order stored in the callback token
+ORDERS = [('best', 'random'), ('random', 'best')]
+
+
+def prepare_message(signer: CallbackSigner, nonce: int, dataset: RowGroups, instance: Tuple[int, int]):
+    questions_asked, position = instance
+    best_row, random_row = dataset[position]
     answers = [best_row, random_row]
     order = [0, 1]
     random.shuffle(order)
@@ -100,60 +107,47 @@ def prepare_message(message_store: Dict[str, Any], instance: Tuple[int, Tuple[Ro
                                                                   answers[order[0]].answer,
                                                                   answers[order[1]].answer)
 
-    time_asked = datetime.now().isoformat()
-
-    uid = uuid.uuid1().hex
-
-    message_store[uid] = {'best': best_row, 'random': random_row, 'time_asked': time_asked}
-
-    order = ['best' if e == 0 else 'random' for e in order]
-
-    button_list = [
-        [InlineKeyboardButton('Ответ А', callback_data='{};{}'.format(uid, order[0])),
-         InlineKeyboardButton('Ответ Б', callback_data='{};{}'.format(uid, order[1]))],
-        [InlineKeyboardButton('Нет разницы', callback_data='{};equal'.format(uid))]
-
-    ]
-    reply_markup = InlineKeyboardMarkup(button_list)
-
-    return questions_asked, message, reply_markup
+    return questions_asked, message, KEYBOARD.render(signer.encode(position, nonce, order[0]))
 
 
 def main():
-    updater = Updater(token=TOKEN)
+    updater = Updater(token=TOKEN, request_kwargs={'con_pool_size': CHAT_WORKERS + 4})
     dispatcher = updater.dispatcher
 
-    dialogs = {}
-
-    exists = os.path.isfile(OUTPUT_FILE)
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-    messages_store = {}
-
-    if not os.path.isfile(CACHE_FILE):
-        print('Creating cache file {} ...'.format(CACHE_FILE))
-        dataset = shuffle(get_best_and_random_answer(prepare_dataset(INPUT_FILE)))
-        with open(CACHE_FILE, 'wb') as f:
-            pickle.dump(dataset, f)
-        print('Created!')
-
-    with open(CACHE_FILE, 'rb') as f:
-        dataset = pickle.load(f)
-
-    with open(OUTPUT_FILE, 'a', newline='') as tsvfile:
-        writer = csv.writer(tsvfile, delimiter='\t')
-
-        if not exists:
-            writer.writerow(['chat_id', 'user', 'result', 'question', 'best_answer', 'random_answer', 'context',
-                             'best_discriminator', 'random_discriminator', 'time_asked', 'time_answered'])
-            tsvfile.flush()
+    # (best, random) pairs are stored as consecutive rows
+    rows = load_or_update(CACHE_FILE, INPUT_FILE, CACHE_PARAMS, Row, 'issssd',
+                          ingest=lambda store, start, end: prepare_dataset(INPUT_FILE, store, start, end),
+                          select=SELECT_PIPELINE.run,
+                          arrange=lambda kept, rows: kept + list(rows),
+                          lazy_text=True)
+    dataset = RowGroups(rows, 2)
+    signer = CallbackSigner(CALLBACK_SECRET or TOKEN, rows.build)
+
+    # every answer compares the two, so the wins of best among the answers that prefer one are tested
+    # against a coin flip (a sign test), not as two samples
+    tallies = Tallies(['best'], [('best', 0.5)])
+    tests = SequentialTests(tallies, DECISIONS_FILE)
+
+    def shuffled(seed=None, position=0, served=None):
+        return OpenItems(ShuffledItems(range(len(dataset)), seed, position), tests, served=served)
+
+    # after the dataset is loaded: their threads restart in forked processes, which the ingest pool
+    # workers must not get
+    lanes = ChatLanes(dispatcher)
+    outbox = Outbox(updater.bot)
+    dialogs = SessionStore(SESSIONS_FILE, shuffled)
+
+    header = ['chat_id', 'user', 'result', 'question', 'best_answer', 'random_answer', 'context',
+              'best_discriminator', 'random_discriminator', 'time_asked', 'time_answered', 'item']
+    with open_sink(OUTPUT_FILE, header, store=ANNOTATIONS_FILE, seen=ANSWERED_FILE, tallies=tallies) as writer:
 
         def start(bot: Bot, update: Update):
             chat_id = update.message.chat_id
-            dataset_rows = list(dataset)
-            random.shuffle(dataset_rows)
             dialogs[chat_id] = {
-                'batch_generator': iter(enumerate(dataset_rows))
+                'batch_generator': shuffled(),
+                'nonce': random.getrandbits(32)
             }
 
             startup_message = '''Добрый день, Толокер!
@@ -161,44 +155,72 @@ def main():
 Каждые 10 фрагментов, система будет выводить количество оценённых ответов.
 '''
 
-            bot.send_message(chat_id=chat_id, text=startup_message)
+            outbox.send_message(chat_id=chat_id, text=startup_message)
 
-            i, message, reply_markup = prepare_message(messages_store, next(dialogs[chat_id]['batch_generator']))
-            bot.send_message(chat_id=chat_id, text=message,
-                             reply_markup=reply_markup, parse_mode='HTML')
+            dialog = dialogs[chat_id]
+            instance = next(dialog['batch_generator'], None)
+            if instance is None:
+                outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                return
+            i, message, reply_markup = prepare_message(signer, dialog['nonce'], dataset, instance)
+            dialogs.save(chat_id)
+            outbox.send_message(chat_id=chat_id, text=message,
+                                reply_markup=reply_markup, parse_mode='HTML')
 
         def reply(bot: Bot, update: Update):
             query = update.callback_query
             chat_id = query.message.chat_id
             user = (update.effective_user.first_name or '') + '@' + (update.effective_user.username or '')
 
-            uid, result = query.data.split(';')
-            if uid in messages_store:
-                best_row = messages_store[uid]['best']
-                random_row = messages_store[uid]['random']
-                time_asked = messages_store[uid]['time_asked']
+            token, choice = query.data.split(';')
+            callback = signer.decode(token)
+            key = '{};{}'.format(chat_id, token)
+            if callback is None:
+                # e.g. a button sent before the dataset or the secret changed
+                print('chat {}: rejected callback token {!r} ({} so far)'.format(chat_id, token, signer.rejected))
+                outbox.send_message(chat_id=chat_id, text=EXPIRED_MESSAGE)
+            elif not writer.claim(key):
+                # a double tap or a redelivered callback: the answer is recorded and the next item sent
+                return
+            else:
+                best_row, random_row = dataset[callback.item]
+                result = choice if choice == 'equal' else ORDERS[callback.order]['ab'.index(choice)]
 
                 writer.writerow([chat_id, user, result, best_row.question, best_row.answer, random_row.answer,
                                  best_row.context, best_row.discriminator, random_row.discriminator,
-                                 time_asked, datetime.now().isoformat()])
-                tsvfile.flush()
+                                 callback.time_asked, datetime.now().isoformat(), callback.item],
+                                key=key,
+                                # 'equal' says nothing about which is better
+                                tally=[('best', result == 'best', best_row.discriminator)] if result != 'equal' else [])
 
             if chat_id not in dialogs:
                 start(bot, query)
             else:
-                i, message, reply_markup = prepare_message(messages_store, next(dialogs[chat_id]['batch_generator']))
-                if i > 0 and i % 10 == 0:
-                    bot.send_message(chat_id=chat_id, text='<i>Вы ответили на {} вопросов</i>'.format(i),
-                                     parse_mode='HTML')
-                bot.send_message(chat_id=chat_id, text=message,
-                                 reply_markup=reply_markup, parse_mode='HTML')
-
-        dispatcher.add_handler(CommandHandler('start', start))
-        dispatcher.add_handler(CallbackQueryHandler(reply))
-
-        updater.start_polling()
-
-        updater.idle()
+                dialog = dialogs[chat_id]
+                instance = next(dialog['batch_generator'], None)
+                if instance is None:
+                    outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                    return
+                i, message, reply_markup = prepare_message(signer, dialog['nonce'], dataset, instance)
+                dialogs.save(chat_id)
+                outbox.send_message(chat_id=chat_id, text=with_progress(message, i),
+                                    reply_markup=reply_markup, parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('start', lanes.wrap(start)))
+        dispatcher.add_handler(CallbackQueryHandler(lanes.wrap(reply)))
+
+        def stats(bot: Bot, update: Update):
+            if is_admin(update.effective_user):
+                outbox.send_message(chat_id=update.message.chat_id, text=tests.report_html(), parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('stats', lanes.wrap(stats)))
+
+        serve(updater, report=tests.report)
+        lanes.close()
+        outbox.close()
+        dialogs.close()
+    # after the sink, whose writer takes the decisions
+    tests.close()
 
 
 if __name__ == '__main__':
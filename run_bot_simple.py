@@ -1,81 +1,80 @@
-import csv
+import html
 import random
+import re
 from datetime import datetime
-from itertools import groupby
 from typing import List, Tuple, Iterator
-import re
 
 import os
-from collections import namedtuple
+from collections import namedtuple, Counter
 
-import pickle
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
 
+from aggregate import group_extremes
+from annotation_store import open_sink
+from callback_token import CALLBACK_SECRET, CallbackSigner
+from dataset_cache import load_or_build
+from ingest import ingest_dialogs
+from keyboard import KeyboardTemplate
+from lanes import CHAT_WORKERS, ChatLanes
+from markup import LABEL_FIRST
+from outbox import Outbox, with_progress
+from permutation import ShuffledItems
+from pipeline import Pipeline, blocking
+from scheduler import SCHEDULER, ScheduledItems, ThompsonScheduler
+from sequential import OpenItems, SequentialTests
+from serving import serve
+from session_store import SessionStore
+from tallies import Tallies, is_admin
+
 
 INPUT_FILE = 'downloads/sber2.csv'
+CACHE_FILE = INPUT_FILE + '.rows'
 OUTPUT_FILE = 'target/sber2_2.tsv'
+SESSIONS_FILE = 'target/sber2_2.sessions'
+ANNOTATIONS_FILE = 'target/sber2_2.annotations'
+ANSWERED_FILE = 'target/sber2_2.answered'
+DECISIONS_FILE = 'target/sber2_2.decisions'
 TOKEN = os.environ['SENSE_BOT_TOKEN']
+INGEST_WORKERS = int(os.environ.get('SENSE_BOT_INGEST_WORKERS', os.cpu_count()))
 OPERATOR_RANDOM = 'random'
 OPERATOR_HUMAN = 'human'
 OPERATOR_BOT = 'bot'
+# operator pairs the live tallies test and the scheduler compares
+PAIRS = [(OPERATOR_HUMAN, OPERATOR_BOT), (OPERATOR_BOT, OPERATOR_RANDOM)]
+
+CACHE_PARAMS = {'pipeline': ['prepare_dataset', 'filter_duplicate_answers', 'mixin_random_answers', 'numerate_ids'],
+                'rendered': {'message': 2}}
 
 Row = namedtuple('Row', 'id question answer operator discriminator')
 
 
 def prepare_dataset(filename=INPUT_FILE) -> Iterator[Row]:
-    with open(filename) as f:
-        csvfile = csv.reader(f, delimiter=',')
-        header = next(csvfile)
-        assert header == ['Is_human', 'Text', 'Predict']
-        index = -1
-        while True:
-            try:
-                index += 1
-                row_id, [is_human, text, discriminator_score] = next(csvfile)
-                chunks = re.findall(r'(<[A-Z_]+> [^<>]*)', text)
-                answer = chunks[-1]
-
-                assert answer.startswith('<ANS_START> '), text
-                answer = answer.replace('<ANS_START> ', '')
-
-                if chunks[-2].startswith('<MAN_START> '):
-                    continue
-                if chunks[-2].startswith('<PAUSE> '):
-                    continue
-
-                assert chunks[-2].startswith('<COR_START> '), [chunks[-2], text]
-                question = chunks[-2].replace('<COR_START> ', '')
-
-                if ('здравствуйте' in answer.lower()) and ('cлужба технической поддержки' in answer.lower()):
-                    print(answer)
-                    continue
-
-                # if len(set(word_tokenize(question))) < 7:
-                #     continue
-
-                row = Row(index, question, answer, OPERATOR_HUMAN if int(is_human) else OPERATOR_BOT,
-                          discriminator_score)
-
-                # if len(set(answer.split())) > 15:
-                #     continue
-
-                # if row.operator == OPERATOR_BOT and float(row.discriminator) < 0.5:
-                #     continue
-
-                # if row.operator != OPERATOR_BOT and random.randint(1, 2) == 1:
-                #     continue
-
-                yield row
-                index += 1
-            except StopIteration:
-                break
-            except IndexError:
-                pass
-
-
-def mixin_random_answers(dataset):
-    dataset = list(dataset)
+    skipped = Counter()
+    dialogs = ingest_dialogs(filename, LABEL_FIRST, skipped, header=['Is_human', 'Text', 'Predict'],
+                             workers=INGEST_WORKERS)
+    for index, (_, question, answer, is_human, discriminator_score) in enumerate(dialogs):
+        # if len(set(word_tokenize(question))) < 7:
+        #     continue
+
+        row = Row(index, question, answer, OPERATOR_HUMAN if int(is_human) else OPERATOR_BOT,
+                  float(discriminator_score))
+
+        # if len(set(answer.split())) > 15:
+        #     continue
+
+        # if row.operator == OPERATOR_BOT and float(row.discriminator) < 0.5:
+        #     continue
+
+        # if row.operator != OPERATOR_BOT and random.randint(1, 2) == 1:
+        #     continue
+
+        yield row
+    print('skipped:', dict(skipped))
+
+
+@blocking
+def mixin_random_answers(dataset: List[Row]):
     answers = [d.answer for d in dataset]
     random.shuffle(answers)
 
@@ -103,19 +102,14 @@ def mixin_random_answers(dataset):
 
 
 def filter_duplicate_answers(dataset):
-    by_question = lambda row: row.question
-
-    for group, diff_answers in groupby(sorted(dataset, key=by_question), key=by_question):
-        data = list(diff_answers)
-        bots = [row for row in data if row.operator == 'bot']
-        if bots:
-            max_score_row = max(bots, key=lambda x: float(x.discriminator))
-            min_score_row = min(bots, key=lambda x: float(x.discriminator))
+    bot_score = lambda row: float(row.discriminator) if row.operator == OPERATOR_BOT else None
 
-            yield max_score_row
-            if len(bots) > 1:
-                yield min_score_row
-            yield from (row for row in data if row.operator != 'bot')
+    for group in group_extremes(dataset, key=lambda row: row.question, score=bot_score).values():
+        if group.count:
+            yield group.max_row
+            if group.count > 1:
+                yield group.min_row
+            yield from group.rest
 
 
 def numerate_ids(dataset):
@@ -125,67 +119,65 @@ def numerate_ids(dataset):
         yield Row(**vals)
 
 
-def batch_generator_generator(data):
-    seq = list(data)
+PREPARE_PIPELINE = Pipeline(prepare_dataset, filter_duplicate_answers, mixin_random_answers, numerate_ids,
+                            name='prepare')
 
-    def batch_generator():
-        questions_asked = 0
-        while True:
-            random.shuffle(seq)
-            for q in seq:
-                yield questions_asked, q
-                questions_asked += 1
-    return batch_generator()
 
+def render_message(row: Row) -> str:
+    question = re.sub(r'\d+', '<NUM>', row.question)
+    answer = re.sub(r'\d+', '<NUM>', row.answer)
+    return "{question}\n<b>Ответ:</b>\n{answer}".format(question=html.escape(question), answer=html.escape(answer))
 
-def prepare_message(instance: Tuple[int, Row]):
-    questions_asked, row = instance
-    message = row.question + '\n' + "<b>Ответ:</b>\n{}".format(row.answer)
-
-    t = datetime.now().isoformat()
 
-    button_list = [
-        [InlineKeyboardButton('Осмысленно', callback_data='{0};{r.id};{r.discriminator};{r.operator};1'.format(t, r=row)),
-         InlineKeyboardButton('Не осмысленно', callback_data='{0};{r.id};{r.discriminator};{r.operator};0'.format(t, r=row))]
+RENDERED = {'message': render_message}
+KEYBOARD = KeyboardTemplate([[('Осмысленно', '{};1'), ('Не осмысленно', '{};0')]])
+FINISHED_MESSAGE = 'Спасибо! Сбор оценок завершён.'
+EXPIRED_MESSAGE = 'Эта кнопка устарела, ответ не записан. Ответьте, пожалуйста, на следующий вопрос.'
 
-    ]
-    reply_markup = InlineKeyboardMarkup(button_list)
 
-    return questions_asked, message, reply_markup
+def prepare_message(signer: CallbackSigner, nonce: int, instance: Tuple[int, Row]):
+    questions_asked, row = instance
+    return questions_asked, row.message, KEYBOARD.render(signer.encode(row.id, nonce))
 
 
 def main():
-    updater = Updater(token=TOKEN)
+    updater = Updater(token=TOKEN, request_kwargs={'con_pool_size': CHAT_WORKERS + 4})
     dispatcher = updater.dispatcher
 
-    dialogs = {}
-
-    exists = os.path.isfile(OUTPUT_FILE)
     os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
 
-    cached_file = INPUT_FILE + '.pickle'
-    if not os.path.isfile(cached_file):
-        print('Creating cache file {} ...'.format(cached_file))
-        dataset = list(numerate_ids(mixin_random_answers(filter_duplicate_answers(prepare_dataset(INPUT_FILE)))))
-        with open(cached_file, 'wb') as f:
-            pickle.dump(dataset, f)
-        print('Created!')
-
-    with open(cached_file, 'rb') as f:
-        dataset = pickle.load(f)
-
-    with open(OUTPUT_FILE, 'a', newline='') as tsvfile:
-        writer = csv.writer(tsvfile, delimiter='\t')
-
-        if not exists:
-            writer.writerow(['chat_id', 'user', 'question_id', 'operator', 'question', 'answer', 'time_asked', 'time_answered',
-                             'is_meaningful', 'discriminator_score'])
-            tsvfile.flush()
+    dataset = load_or_build(CACHE_FILE, INPUT_FILE, CACHE_PARAMS, Row, 'isssd',
+                            lambda: PREPARE_PIPELINE.run(INPUT_FILE),
+                            lazy_text=True, rendered=RENDERED)
+    signer = CallbackSigner(CALLBACK_SECRET or TOKEN, dataset.build)
+
+    tallies = Tallies([OPERATOR_HUMAN, OPERATOR_BOT, OPERATOR_RANDOM], PAIRS)
+    tests = SequentialTests(tallies, DECISIONS_FILE)
+    scheduler = None
+    if SCHEDULER == 'thompson':
+        scheduler = ThompsonScheduler(tallies, dataset, dataset.columns['operator'], tests=tests)
+
+    def shuffled(seed=None, position=0, pools=None, served=None):
+        if scheduler is not None:
+            return ScheduledItems(scheduler, seed, position, pools, repeat=True)
+        return OpenItems(ShuffledItems(dataset, seed, position, repeat=True), tests, lambda row: row.operator,
+                         served=served)
+
+    # after the dataset is loaded: their threads restart in forked processes, which the ingest pool
+    # workers must not get
+    lanes = ChatLanes(dispatcher)
+    outbox = Outbox(updater.bot)
+    dialogs = SessionStore(SESSIONS_FILE, shuffled)
+
+    header = ['chat_id', 'user', 'question_id', 'operator', 'question', 'answer', 'time_asked', 'time_answered',
+              'is_meaningful', 'discriminator_score', 'item']
+    with open_sink(OUTPUT_FILE, header, store=ANNOTATIONS_FILE, seen=ANSWERED_FILE, tallies=tallies) as writer:
 
         def start(bot: Bot, update: Update):
             chat_id = update.message.chat_id
             dialogs[chat_id] = {
-                'batch_generator': batch_generator_generator(dataset)
+                'batch_generator': shuffled(),
+                'nonce': random.getrandbits(32)
             }
 
             startup_message = '''Добрый день! Сейчас вам будут представлены фрагменты из чата оператора поддержки банка с клиентом. Просим вас оценить ответ оператора на вопрос клиента по степени осмысленности. Осмысленность понимайте как ваше субъективное ощущение того, что оператор понимает запрос клиента и пытается помочь.
@@ -193,41 +185,69 @@ def main():
 Каждые 10 фрагментов, система будет выводить количество оценённых ответов.
 '''
 
-            bot.send_message(chat_id=chat_id, text=startup_message)
+            outbox.send_message(chat_id=chat_id, text=startup_message)
 
-            i, message, reply_markup = prepare_message(next(dialogs[chat_id]['batch_generator']))
-            bot.send_message(chat_id=chat_id, text=message,
-                             reply_markup=reply_markup, parse_mode='HTML')
+            dialog = dialogs[chat_id]
+            instance = next(dialog['batch_generator'], None)
+            if instance is None:
+                outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                return
+            i, message, reply_markup = prepare_message(signer, dialog['nonce'], instance)
+            dialogs.save(chat_id)
+            outbox.send_message(chat_id=chat_id, text=message,
+                                reply_markup=reply_markup, parse_mode='HTML')
 
         def reply(bot: Bot, update: Update):
             query = update.callback_query
             chat_id = query.message.chat_id
             user = (update.effective_user.first_name or '') + '@' + (update.effective_user.username or '')
 
-            time_asked, question_id, score, operator, is_meaningful = query.data.split(';')
-            question_id = int(question_id)
-            question = dataset[question_id][1]
-            answer = dataset[question_id][2]
-            writer.writerow([chat_id, user, question_id, operator, question, answer,
-                             time_asked, datetime.now().isoformat(), is_meaningful, score])
-            tsvfile.flush()
+            token, is_meaningful = query.data.split(';')
+            callback = signer.decode(token)
+            key = '{};{}'.format(chat_id, token)
+            if callback is None:
+                # e.g. a button sent before the dataset or the secret changed
+                print('chat {}: rejected callback token {!r} ({} so far)'.format(chat_id, token, signer.rejected))
+                outbox.send_message(chat_id=chat_id, text=EXPIRED_MESSAGE)
+            elif not writer.claim(key):
+                # a double tap or a redelivered callback: the answer is recorded and the next item sent
+                return
+            else:
+                row = dataset[callback.item]
+                writer.writerow([chat_id, user, row.id, row.operator, row.question, row.answer,
+                                 callback.time_asked, datetime.now().isoformat(), is_meaningful, row.discriminator,
+                                 callback.item],
+                                key=key,
+                                tally=[(row.operator, is_meaningful == '1', row.discriminator)])
 
             if chat_id not in dialogs:
                 start(bot, query)
             else:
-                i, message, reply_markup = prepare_message(next(dialogs[chat_id]['batch_generator']))
-                if i > 0 and i % 10 == 0:
-                    bot.send_message(chat_id=chat_id, text='<i>Вы ответили на {} вопросов</i>'.format(i),
-                                     parse_mode='HTML')
-                bot.send_message(chat_id=chat_id, text=message,
-                                 reply_markup=reply_markup, parse_mode='HTML')
-
-        dispatcher.add_handler(CommandHandler('start', start))
-        dispatcher.add_handler(CallbackQueryHandler(reply))
-
-        updater.start_polling()
-
-        updater.idle()
+                dialog = dialogs[chat_id]
+                instance = next(dialog['batch_generator'], None)
+                if instance is None:
+                    outbox.send_message(chat_id=chat_id, text=FINISHED_MESSAGE)
+                    return
+                i, message, reply_markup = prepare_message(signer, dialog['nonce'], instance)
+                dialogs.save(chat_id)
+                outbox.send_message(chat_id=chat_id, text=with_progress(message, i),
+                                    reply_markup=reply_markup, parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('start', lanes.wrap(start)))
+        dispatcher.add_handler(CallbackQueryHandler(lanes.wrap(reply)))
+
+        def stats(bot: Bot, update: Update):
+            if is_admin(update.effective_user):
+                outbox.send_message(chat_id=update.message.chat_id, text=tests.report_html(), parse_mode='HTML')
+
+        dispatcher.add_handler(CommandHandler('stats', lanes.wrap(stats)))
+
+        serve(updater, report=tests.report)
+        lanes.close()
+        outbox.close()
+        dialogs.close()
+    # after the sink, whose writer takes the decisions
+    tests.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+import hashlib
+import math
+import os
+import random
+from collections.abc import Iterator
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from permutation import ShuffledItems
+from sequential import SequentialTests
+from tallies import Tallies, pair_operators
+
+# Adaptive item order (SENSE_BOT_SCHEDULER=thompson). Instead of one shuffled
+# pass over all items, each item is drawn from the pool of an operator chosen
+# by Thompson sampling on the live tallies: a rate is drawn from every
+# operator's Beta posterior, the compared pair that looks closest in that draw
+# (relative to its posterior spread) gets the item, and within the pair the
+# operator whose next answer narrows the difference most. Pairs that have
+# separated are drawn as close ever more rarely, so the answers go to the
+# comparisons still open. A share `explore` of the items goes to a uniformly
+# chosen operator. Operators in no compared pair, e.g. a control, keep their
+# base share (the share of their items): they get items at that rate before
+# any sampling. A pick costs O(operators); the pools are built once.
+# With sequential tests that stop decided pairs (see sequential), only the
+# open pairs are compared and only their operators served.
+
+SCHEDULER = os.environ.get('SENSE_BOT_SCHEDULER', 'shuffle')
+EXPLORE = float(os.environ.get('SENSE_BOT_EXPLORE', '0.1'))
+
+
+def operator_pools(operators: Sequence[str], names: Sequence[str]) -> Dict[str, np.ndarray]:
+    """Positions of the items of every operator in `names`, given the operator of each item."""
+    codes = {name: i for i, name in enumerate(names)}
+    item_codes = np.fromiter((codes.get(operator, -1) for operator in operators), dtype=np.int64,
+                             count=len(operators))
+    return {name: np.flatnonzero(item_codes == i) for i, name in enumerate(names)}
+
+
+def _pool_seed(seed: int, operator: str) -> int:
+    digest = hashlib.blake2b('{}:{}'.format(seed, operator).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+class ThompsonScheduler:
+    """Chooses operators for the items of `items`, whose operators are `operators`, from the
+    posteriors of `tallies` and the operator pairs it compares, or the pairs `tests` keeps open."""
+
+    def __init__(self, tallies: Tallies, items: Sequence, operators: Sequence[str], explore: float = EXPLORE,
+                 tests: Optional[SequentialTests] = None):
+        self.tallies = tallies
+        self.items = items
+        self.pools = operator_pools(operators, tallies.operators)
+        self.explore = explore
+        self.tests = tests
+        self.paired = {operator for pair in tallies.pairs for operator in pair_operators(pair)}
+        self.sizes = {operator: len(pool) for operator, pool in self.pools.items()}
+        total = sum(self.sizes.values())
+        for operator in tallies.operators:
+            if operator not in self.paired and self.sizes[operator]:
+                print('scheduler: {} is in no compared pair, served at its base share of {:.1%}'.format(
+                    operator, self.sizes[operator] / total))
+
+    def open_pairs(self) -> Sequence[Tuple[str, str]]:
+        return self.tallies.pairs if self.tests is None else self.tests.open_pairs()
+
+    def servable(self, operators: Sequence[str]) -> List[str]:
+        """Those of `operators` still served: none once the campaign is over, else all but the ones
+        only decided pairs compare."""
+        if self.tests is None or not self.tests.early_stop:
+            return list(operators)
+        if self.tests.finished:
+            return []
+        needed = self.tests.served_operators()
+        return [operator for operator in operators if operator in needed]
+
+    def choose(self, available: Sequence[str]) -> str:
+        """The operator of the next item, one of `available` (operators with items left)."""
+        unpaired = [operator for operator in available if operator not in self.paired]
+        if unpaired:
+            weights = [self.sizes[operator] for operator in unpaired]
+            if random.random() < sum(weights) / sum(self.sizes[operator] for operator in available):
+                return random.choices(unpaired, weights)[0]
+            available = [operator for operator in available if operator in self.paired]
+        if random.random() < self.explore:
+            return random.choice(available)
+        draws, variances, counts = {}, {}, {}
+        for operator, (neg, pos) in zip(self.tallies.operators, self.tallies.totals()):
+            a, b = pos + 1, neg + 1
+            draws[operator] = random.betavariate(a, b)
+            variances[operator] = a * b / ((a + b) ** 2 * (a + b + 1))
+            counts[operator] = pos + neg
+        open_pairs = [(x, y) for x, y in self.open_pairs() if x in available and y in available]
+        if not open_pairs:
+            return random.choice(available)
+        pair = min(open_pairs, key=lambda p: abs(draws[p[0]] - draws[p[1]]) /
+                   math.sqrt(variances[p[0]] + variances[p[1]]))
+        # one more answer shrinks the posterior variance by about variance / (n + 3)
+        return max(pair, key=lambda operator: variances[operator] / (counts[operator] + 3))
+
+
+class ScheduledItems(Iterator):
+    """Yields `(position, item)` like ShuffledItems, taking every item from the pool of the operator
+    the scheduler chooses. Each pool has its own per-session order; the state is
+    `(seed, position, {operator: position in its pool})`.
+    """
+
+    def __init__(self, scheduler: ThompsonScheduler, seed: Optional[int] = None, position: int = 0,
+                 pools: Optional[Dict[str, int]] = None, repeat: bool = False):
+        self.scheduler = scheduler
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.position = position
+        pools = pools or {}
+        self.pools = {operator: ShuffledItems(pool, _pool_seed(self.seed, operator), pools.get(operator, 0), repeat)
+                      for operator, pool in scheduler.pools.items() if len(pool)}
+        self.repeat = repeat
+
+    @property
+    def state(self):
+        return self.seed, self.position, {operator: pool.position for operator, pool in self.pools.items()}
+
+    def _available(self) -> List[str]:
+        return self.scheduler.servable([operator for operator, pool in self.pools.items()
+                                        if self.repeat or pool.position < len(pool.items)])
+
+    def __next__(self):
+        available = self._available()
+        if not available:
+            raise StopIteration
+        _, index = next(self.pools[self.scheduler.choose(available)])
+        position = self.position
+        self.position += 1
+        return position, self.scheduler.items[int(index)]
@@ -0,0 +1,271 @@
+import html
+import math
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+from collections.abc import Iterator
+from datetime import datetime
+from typing import Callable, Optional, Sequence, Set, Tuple
+
+from tallies import Pair, Tallies, is_one_sample, pair_operators
+
+# Sequential tests of the compared operator pairs, so a campaign can stop as
+# soon as a comparison is settled instead of after a fixed number of answers.
+# Each pair runs a mixture sequential probability ratio test (mSPRT) on the
+# difference of the positive rates, with a normal mixture of standard
+# deviation `tau` over the difference and the normal approximation of its
+# estimate, whose variance uses rates shrunk towards 1/2 ((k + 0.5) / (n + 1)).
+# No pair is decided before both operators have `min_answers` answers, at
+# least MIN_ANSWERS_FLOOR. The test is evaluated after every recorded answer. Its p-value
+# stays valid however often it is looked at, and the pair is decided once it
+# falls below `alpha`. A pair of an operator and a rate (see tallies) tests
+# the operator's rate against it the same way, with the variance of the
+# estimate under that rate. With `max_answers`, a pair whose operators both
+# reached that many answers undecided is closed as inconclusive.
+#
+# With SENSE_BOT_EARLY_STOP=1 decided pairs stop being served: the scheduler
+# leaves them out, and sessions skip the items of operators that only decided
+# pairs compare. Operators in no pair are served as before. Once no pair is
+# open the campaign is over. Decisions are kept in `filename`, so a restart
+# does not reopen them; a thread of their own writes them there, so the
+# annotation writer that evaluates the tests never waits for the database.
+
+ALPHA = float(os.environ.get('SENSE_BOT_ALPHA', '0.05'))
+TAU = float(os.environ.get('SENSE_BOT_MSPRT_TAU', '0.1'))
+MIN_ANSWERS = int(os.environ.get('SENSE_BOT_MIN_ANSWERS', '30'))
+# below this the normal approximation is too rough to decide on, whatever the p-value says
+MIN_ANSWERS_FLOOR = 20
+MAX_ANSWERS = int(os.environ.get('SENSE_BOT_MAX_ANSWERS', '0'))
+EARLY_STOP = os.environ.get('SENSE_BOT_EARLY_STOP', '0') == '1'
+
+OPEN, FIRST_BETTER, SECOND_BETTER, INCONCLUSIVE = range(4)
+DECISIONS = ['open', 'first better', 'second better', 'inconclusive']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS decisions (
+    first TEXT NOT NULL,
+    second TEXT NOT NULL,
+    decision TEXT NOT NULL,
+    p_value REAL,
+    n_first INTEGER,
+    n_second INTEGER,
+    time_decided TEXT,
+    PRIMARY KEY (first, second)
+)
+'''
+
+
+def _mixture_ratio(difference: float, variance: float, tau: float) -> float:
+    tau2 = tau * tau
+    exponent = tau2 * difference ** 2 / (2 * variance * (variance + tau2))
+    return math.sqrt(variance / (variance + tau2)) * math.exp(min(exponent, 700.0))
+
+
+def _smoothed(pos: int, n: int) -> float:
+    # kept away from 0 and 1, whose plug-in variance is 0 and makes the test overconfident at small n
+    return (pos + 0.5) / (n + 1)
+
+
+def msprt_statistic(pos_a: int, n_a: int, pos_b: int, n_b: int, tau: float = TAU) -> float:
+    """Mixture likelihood ratio of a difference in the positive rates against none."""
+    s_a, s_b = _smoothed(pos_a, n_a), _smoothed(pos_b, n_b)
+    variance = s_a * (1 - s_a) / n_a + s_b * (1 - s_b) / n_b
+    return _mixture_ratio(pos_a / n_a - pos_b / n_b, variance, tau)
+
+
+def msprt_statistic_rate(pos: int, n: int, rate: float, tau: float = TAU) -> float:
+    """Mixture likelihood ratio of a positive rate other than `rate` against `rate`, with the
+    variance of the estimate under `rate`, which must be strictly between 0 and 1."""
+    return _mixture_ratio(pos / n - rate, rate * (1 - rate) / n, tau)
+
+
+class SequentialTests:
+    """mSPRTs of the pairs of `tallies`, updated whenever it records an answer.
+
+    The state is in shared memory like the tallies, so forked workers see the decisions taken in
+    the process that records the answers.
+    """
+
+    def __init__(self, tallies: Tallies, filename: Optional[str] = None, alpha: float = ALPHA, tau: float = TAU,
+                 min_answers: int = MIN_ANSWERS, max_answers: int = MAX_ANSWERS, early_stop: bool = EARLY_STOP):
+        if min_answers < MIN_ANSWERS_FLOOR:
+            raise ValueError('min_answers is {}, at least {} are needed'.format(min_answers, MIN_ANSWERS_FLOOR))
+        for pair in tallies.pairs:
+            if is_one_sample(pair) and not 0 < pair[1] < 1:
+                raise ValueError('{} is tested against the rate {}, not strictly between 0 and 1'.format(*pair))
+        self.tallies = tallies
+        self.pairs = list(tallies.pairs)
+        self.filename = filename
+        self.alpha = alpha
+        self.tau = tau
+        self.min_answers = min_answers
+        self.max_answers = max_answers
+        self.early_stop = early_stop
+        context = multiprocessing.get_context('fork')
+        self.decisions = context.Array('b', len(self.pairs))
+        self.p_values = context.Array('d', [1.0] * len(self.pairs))
+        if filename is not None:
+            self._load()
+        self.recorder = None
+        # started by the first decision; a forked process (see sharding) has none
+        os.register_at_fork(after_in_child=self._forget_recorder)
+        tallies.listeners.append(self.update)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.filename)
+        db.execute(_SCHEMA)
+        return db
+
+    def _load(self):
+        # a short-lived connection, so forked workers inherit none
+        keys = [self._key(pair) for pair in self.pairs]
+        db = self._connect()
+        try:
+            for first, second, decision, p_value in db.execute(
+                    'SELECT first, second, decision, p_value FROM decisions'):
+                if (first, second) in keys:
+                    i = keys.index((first, second))
+                    self.decisions[i] = DECISIONS.index(decision)
+                    self.p_values[i] = p_value
+        finally:
+            db.close()
+
+    @staticmethod
+    def _key(pair: Pair) -> Tuple[str, str]:
+        # the rate of a one-sample pair is stored as text
+        return pair[0], str(pair[1])
+
+    def _record(self, i: int, n_first: int, n_second: Optional[int]):
+        print('sequential test: {} vs {}: {} (p = {:.4g}, n = {}{})'.format(
+            *self.pairs[i], DECISIONS[self.decisions[i]], self.p_values[i], n_first,
+            '' if n_second is None else ', {}'.format(n_second)))
+        if self.filename is None:
+            return
+        if self.recorder is None:
+            self.records = queue.Queue()
+            self.recorder = threading.Thread(target=self._write_decisions, name='decisions', daemon=True)
+            self.recorder.start()
+        self.records.put((*self._key(self.pairs[i]), DECISIONS[self.decisions[i]], self.p_values[i], n_first,
+                          n_second, datetime.now().isoformat()))
+
+    def _write_decisions(self):
+        while True:
+            row = self.records.get()
+            if row is None:
+                return
+            try:
+                db = self._connect()
+                try:
+                    with db:
+                        db.execute('INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+                finally:
+                    db.close()
+            except sqlite3.Error as e:
+                # the decision holds until a restart, which reopens the pair
+                print('sequential test: failed to record {} vs {}: {}'.format(row[0], row[1], e))
+
+    def _forget_recorder(self):
+        self.recorder = None
+
+    def close(self):
+        """Waits for the decisions taken so far to be recorded."""
+        if self.recorder is not None:
+            self.records.put(None)
+            self.recorder.join()
+            self.recorder = None
+
+    def update(self):
+        """Evaluates the open pairs on the current tallies, O(pairs)."""
+        totals = self.tallies.totals()
+        for i, (a, b) in enumerate(self.pairs):
+            if self.decisions[i] != OPEN:
+                continue
+            neg_a, pos_a = totals[self.tallies.index[a]]
+            n_a = pos_a + neg_a
+            if is_one_sample((a, b)):
+                n_b, n = None, n_a
+                if n < self.min_answers:
+                    continue
+                statistic = msprt_statistic_rate(pos_a, n_a, b, self.tau)
+                first_better = pos_a / n_a > b
+            else:
+                neg_b, pos_b = totals[self.tallies.index[b]]
+                n_b = pos_b + neg_b
+                n = min(n_a, n_b)
+                if n < self.min_answers:
+                    continue
+                statistic = msprt_statistic(pos_a, n_a, pos_b, n_b, self.tau)
+                first_better = pos_a / n_a > pos_b / n_b
+            self.p_values[i] = min(self.p_values[i], 1 / statistic)
+            if self.p_values[i] <= self.alpha:
+                self.decisions[i] = FIRST_BETTER if first_better else SECOND_BETTER
+            elif self.max_answers and n >= self.max_answers:
+                self.decisions[i] = INCONCLUSIVE
+            else:
+                continue
+            self._record(i, n_a, n_b)
+
+    def open_pairs(self) -> Sequence[Pair]:
+        """The pairs still served: all of them without early stopping."""
+        if not self.early_stop:
+            return self.pairs
+        return [pair for pair, decision in zip(self.pairs, self.decisions[:]) if decision == OPEN]
+
+    def served_operators(self) -> Set[str]:
+        """Operators of open pairs and those in no pair."""
+        compared = {operator for pair in self.pairs for operator in pair_operators(pair)}
+        return set(self.tallies.operators) - compared | {operator for pair in self.open_pairs()
+                                                         for operator in pair_operators(pair)}
+
+    @property
+    def finished(self) -> bool:
+        return not self.open_pairs()
+
+    def report(self) -> str:
+        lines = [self.tallies.report(), '', 'mSPRT (alpha = {}, tau = {}){}'.format(
+            self.alpha, self.tau, ', decided pairs are not served' if self.early_stop else '')]
+        for (a, b), decision, p_value in zip(self.pairs, self.decisions[:], self.p_values[:]):
+            lines.append('{} vs {}: {}, p = {:.4g}'.format(a, b, DECISIONS[decision], p_value))
+        return '\n'.join(lines)
+
+    def report_html(self) -> str:
+        return '<pre>{}</pre>'.format(html.escape(self.report()))
+
+
+class OpenItems(Iterator):
+    """Wraps a ShuffledItems to skip, with early stopping, the items whose operator (by
+    `operator_of`) is no longer served, and to end once every pair is decided. Without
+    `operator_of` only the latter. Yields `(number of items served before, item)`; `served`, which
+    the session keeps next to the state, starts at the position of `items` unless given."""
+
+    def __init__(self, items: Iterator, tests: SequentialTests, operator_of: Optional[Callable] = None,
+                 served: Optional[int] = None):
+        self.items = items
+        self.tests = tests
+        self.operator_of = operator_of
+        self.served = items.position if served is None else served
+
+    @property
+    def state(self):
+        return self.items.state
+
+    def _next(self):
+        if self.operator_of is None or not self.tests.early_stop:
+            return next(self.items)[1]
+        needed = self.tests.served_operators()
+        # a whole pass without a needed item means there is none left to serve
+        for _ in range(len(self.items.items)):
+            _, item = next(self.items)
+            if self.operator_of(item) in needed:
+                return item
+        raise StopIteration
+
+    def __next__(self):
+        if self.tests.finished:
+            raise StopIteration
+        item = self._next()
+        served = self.served
+        self.served += 1
+        return served, item
@@ -0,0 +1,199 @@
+import hmac
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Optional
+
+from telegram import Update
+
+from sharding import PROCESSES, Shards
+
+# How the bots receive updates. Long polling stays the default; with
+# SENSE_BOT_MODE=webhook a local HTTP server accepts update JSON (from
+# Telegram, a reverse proxy, or recorded updates posted by `replay`) and
+# hands it to the dispatcher. The secret may come in Telegram's secret token
+# header or as the last component of the request path.
+#
+# With SENSE_BOT_STATS_PORT set, GET on that local port returns the bot's
+# report (e.g. its live tallies) as text.
+
+MODE = os.environ.get('SENSE_BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.environ.get('SENSE_BOT_WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('SENSE_BOT_WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.environ.get('SENSE_BOT_WEBHOOK_SECRET', '')
+# public url to register with Telegram, e.g. https://example.org/bot; left unset behind a proxy or when testing
+WEBHOOK_URL = os.environ.get('SENSE_BOT_WEBHOOK_URL')
+
+STATS_LISTEN = os.environ.get('SENSE_BOT_STATS_LISTEN', '127.0.0.1')
+STATS_PORT = int(os.environ.get('SENSE_BOT_STATS_PORT', '0'))
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, code: int):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _authorized(self) -> bool:
+        secret = self.server.secret
+        given = self.headers.get(SECRET_HEADER) or self.path.rstrip('/').rsplit('/', 1)[-1]
+        return hmac.compare_digest(given.encode(), secret.encode())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self._authorized():
+            self._respond(403)
+            return
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self._respond(400)
+            return
+        self.server.updates.put(data)
+        self._respond(200)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """Accepts updates over HTTP and dispatches them from a single thread, in arrival order."""
+
+    daemon_threads = True
+
+    def __init__(self, dispatcher, secret: str, address=(WEBHOOK_LISTEN, WEBHOOK_PORT)):
+        super().__init__(address, WebhookHandler)
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.updates = queue.Queue()
+        self.dispatch_thread = threading.Thread(target=self._dispatch, name='webhook-dispatch', daemon=True)
+
+    def _dispatch(self):
+        while True:
+            data = self.updates.get()
+            if data is None:
+                return
+            # a bad update must not stop the ones after it; its 200 has already been sent
+            try:
+                self.dispatcher.process_update(Update.de_json(data, self.dispatcher.bot))
+            except Exception as e:
+                print('webhook: dropped update {!r}: {!r}'.format(str(data)[:200], e))
+
+    def start(self):
+        self.dispatch_thread.start()
+        threading.Thread(target=self.serve_forever, name='webhook-http', daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # updates received so far are still dispatched
+        self.updates.put(None)
+        self.dispatch_thread.join()
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.report().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StatsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, report: Callable[[], str], address=(STATS_LISTEN, STATS_PORT)):
+        super().__init__(address, StatsHandler)
+        self.report = report
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='stats-http', daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _wait_for_signal():
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        pass
+
+
+def serve(updater, mode: str = MODE, processes: int = PROCESSES, report: Optional[Callable[[], str]] = None,
+          stats_port: int = STATS_PORT):
+    """Runs the bot until SIGINT/SIGTERM, by long polling or as a webhook.
+
+    With several `processes` updates are handled in forked workers (see sharding). serve then
+    also returns in every worker once it is done, so the cleanup after it runs there as well.
+    With `report` and `stats_port` the supervisor serves the report text on that port.
+    """
+    if mode not in ('polling', 'webhook'):
+        raise ValueError('unknown serving mode {!r}'.format(mode))
+    if mode == 'webhook' and not WEBHOOK_SECRET:
+        raise ValueError('SENSE_BOT_WEBHOOK_SECRET must be set in webhook mode')
+
+    shards = None
+    if processes > 1:
+        shards = Shards(updater.dispatcher, processes)
+        if not shards.start():
+            return
+    stats = None
+    if report is not None and stats_port:
+        stats = StatsServer(report, (STATS_LISTEN, stats_port))
+        stats.start()
+    try:
+        _serve(updater, mode)
+    finally:
+        if stats is not None:
+            stats.stop()
+        if shards is not None:
+            shards.stop()
+
+
+def _serve(updater, mode: str):
+    if mode == 'polling':
+        updater.start_polling()
+        updater.idle()
+        return
+
+    server = WebhookServer(updater.dispatcher, WEBHOOK_SECRET)
+    server.start()
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(url='{}/{}'.format(WEBHOOK_URL.rstrip('/'), WEBHOOK_SECRET))
+    print('Listening for updates on {}:{}'.format(*server.server_address))
+    _wait_for_signal()
+    server.stop()
+
+
+def replay(updates: Iterable[dict], url: Optional[str] = None, secret: str = WEBHOOK_SECRET):
+    """Posts recorded updates to a webhook server, e.g. for testing a bot offline."""
+    url = url or 'http://{}:{}/'.format(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    for data in updates:
+        request = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'), method='POST',
+                                         headers={'Content-Type': 'application/json', SECRET_HEADER: secret})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+
+if __name__ == '__main__':
+    # python serving.py updates.jsonl [url]
+    with open(sys.argv[1], encoding='utf-8') as f:
+        replay((json.loads(line) for line in f if line.strip()), *sys.argv[2:3])
@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from permutation import ShuffledItems
+
+# Annotator sessions are kept in SQLite (WAL mode), so a restart resumes every
+# chat where it stopped. A session is just its shuffle state (seed, position)
+# and the nonce of its callback tokens; sent items need no record since the
+# callback tokens carry them. A scheduled session (see scheduler) also keeps
+# its positions in the operator pools, and one that skips items (see
+# sequential) the number of items it served. Sessions are read on first use, so
+# startup does not depend on how many there are.
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id INTEGER PRIMARY KEY,
+    seed INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    nonce INTEGER NOT NULL,
+    pools TEXT,
+    served INTEGER
+)
+'''
+
+Dialog = Dict[str, Any]
+
+
+class SessionStore(MutableMapping):
+    """`chat_id -> dialog` where a dialog is `{'batch_generator': ShuffledItems, 'nonce': int}`.
+    `items(seed, position)` recreates the generator of a stored session, `items(seed, position, pools)`
+    that of a scheduled one and `items(seed, position, served=served)` that of one with a `served` count.
+
+    Assigning a dialog stores it; after advancing its generator call `save(chat_id)`. Loaded dialogs
+    stay in memory. All operations are serialized by a lock, so the store can be shared by handler
+    threads.
+    """
+
+    def __init__(self, filename: str, items: Callable[[int, int], ShuffledItems]):
+        self.filename = filename
+        self.items = items
+        self._connect()
+        # a forked worker process (see sharding) opens its own connection
+        os.register_at_fork(after_in_child=self._reconnect)
+
+    def _connect(self):
+        self.db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # WAL commits survive a crash of the bot without an fsync each
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(_SCHEMA)
+        columns = [name for _, name, *_ in self.db.execute('PRAGMA table_info(sessions)')]
+        for column, kind in [('pools', 'TEXT'), ('served', 'INTEGER')]:
+            if column not in columns:
+                self.db.execute('ALTER TABLE sessions ADD COLUMN {} {}'.format(column, kind))
+        self.loaded = {}  # type: Dict[int, Dialog]
+        self.lock = threading.RLock()
+
+    def _reconnect(self):
+        # the inherited connection must not be used, nor closed, in the child
+        self.inherited = self.db
+        self._connect()
+
+    def _load(self, chat_id: int) -> Optional[Dialog]:
+        row = self.db.execute('SELECT seed, position, nonce, pools, served FROM sessions WHERE chat_id = ?',
+                              (chat_id,)).fetchone()
+        if row is None:
+            return None
+        seed, position, nonce, pools, served = row
+        if pools is not None:
+            items = self.items(seed, position, json.loads(pools))
+        elif served is not None:
+            items = self.items(seed, position, served=served)
+        else:
+            items = self.items(seed, position)
+        return {'batch_generator': items, 'nonce': nonce}
+
+    def __getitem__(self, chat_id: int) -> Dialog:
+        with self.lock:
+            dialog = self.loaded.get(chat_id)
+            if dialog is None:
+                dialog = self._load(chat_id)
+                if dialog is None:
+                    raise KeyError(chat_id)
+                self.loaded[chat_id] = dialog
+            return dialog
+
+    def __setitem__(self, chat_id: int, dialog: Dialog):
+        with self.lock:
+            self.loaded[chat_id] = dialog
+            self.save(chat_id)
+
+    def save(self, chat_id: int):
+        with self.lock:
+            dialog = self.loaded[chat_id]
+            seed, position, *pools = dialog['batch_generator'].state
+            served = getattr(dialog['batch_generator'], 'served', None)
+            self.db.execute('INSERT OR REPLACE INTO sessions (chat_id, seed, position, nonce, pools, served) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (chat_id, seed, position, dialog['nonce'], json.dumps(pools[0]) if pools else None, served))
+
+    def __delitem__(self, chat_id: int):
+        with self.lock:
+            self.loaded.pop(chat_id, None)
+            if self.db.execute('DELETE FROM sessions WHERE chat_id = ?', (chat_id,)).rowcount == 0:
+                raise KeyError(chat_id)
+
+    def __contains__(self, chat_id) -> bool:
+        try:
+            self[chat_id]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[int]:
+        with self.lock:
+            return iter([chat_id for chat_id, in self.db.execute('SELECT chat_id FROM sessions')])
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import signal
+from typing import Dict, List
+
+from telegram import Update
+
+# With SENSE_BOT_PROCESSES > 1 the bot runs as a supervisor that receives the
+# updates and forks worker processes, each handling the chats whose id hashes
+# to it. Workers are forked after the handlers are set up and inherit them;
+# lanes, sessions and the annotation sink re-initialize themselves in a
+# worker, and annotations are still written by the supervisor alone. A
+# worker that dies would leave its chats unanswered, so the supervisor shuts
+# the bot down once it finds one dead.
+
+PROCESSES = int(os.environ.get('SENSE_BOT_PROCESSES', '1'))
+
+
+def shard_key(update) -> int:
+    chat = update.effective_chat
+    return chat.id if chat is not None else 0
+
+
+class Shards:
+    """Worker processes behind a dispatcher. Once started, `dispatcher.process_update` in the
+    supervisor routes each update to the worker of its chat, where it is dispatched as usual."""
+
+    def __init__(self, dispatcher, processes: int = PROCESSES):
+        self.dispatcher = dispatcher
+        self.process_update = dispatcher.process_update
+        context = multiprocessing.get_context('fork')
+        self.queues = [context.Queue() for _ in range(processes)]
+        self.pids = []  # type: List[int]
+        self.statuses = {}  # type: Dict[int, int]
+
+    def start(self) -> bool:
+        """Forks the workers. Returns True in the supervisor; in a worker it returns False once the
+        supervisor has stopped and the updates of the worker are dispatched."""
+        for updates in self.queues:
+            pid = os.fork()
+            if pid == 0:
+                self._work(updates)
+                return False
+            self.pids.append(pid)
+        self.dispatcher.process_update = self.route
+        return True
+
+    def _work(self, updates):
+        # the supervisor decides when to stop, after its last update is queued
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        while True:
+            data = updates.get()
+            if data is None:
+                return
+            # a bad update must not take the worker, and the chats of its shard, down with it
+            try:
+                self.process_update(Update.de_json(data, self.dispatcher.bot))
+            except Exception as e:
+                print('worker {}: dropped update {!r}: {!r}'.format(os.getpid(), str(data)[:200], e))
+
+    def _alive(self, shard: int) -> bool:
+        pid = self.pids[shard]
+        if pid not in self.statuses:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if not done:
+                return True
+            self.statuses[pid] = status
+            print('worker {} exited with status {}, its chats are no longer served; stopping the bot'.format(
+                pid, status))
+            # stops the updater or the webhook server like a ^C, and serve() then stops the other workers
+            os.kill(os.getpid(), signal.SIGTERM)
+        return False
+
+    def route(self, update):
+        shard = hash(shard_key(update)) % len(self.queues)
+        if not self._alive(shard):
+            print('dropped an update of chat {}, its worker is dead'.format(shard_key(update)))
+            return
+        self.queues[shard].put(update.to_dict())
+
+    def stop(self):
+        self.dispatcher.process_update = self.process_update
+        for updates in self.queues:
+            updates.put(None)
+        for pid in self.pids:
+            status = self.statuses[pid] if pid in self.statuses else os.waitpid(pid, 0)[1]
+            if status != 0:
+                print('worker {} exited with status {}'.format(pid, status))
@@ -0,0 +1,174 @@
+import bisect
+import html
+import math
+import multiprocessing
+import os
+from itertools import combinations
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+from scipy import stats
+
+# Running counts of the recorded answers, so the state of a campaign can be
+# read while it runs instead of rerunning compare()/plot_beta on a copy of the
+# tsv. Counts are [negative, positive] per operator and discriminator bucket,
+# as in the notebooks, and live in shared memory: the annotation writer adds
+# the answers it records (after dedup), and every worker process reads them.
+# A report costs the same however many answers there are.
+
+BUCKETS = [0.25, 0.5, 0.75]
+CREDIBLE = 0.95
+# user ids or usernames allowed to use /stats
+ADMINS = set(filter(None, os.environ.get('SENSE_BOT_ADMINS', '').replace(' ', '').split(',')))
+
+Tally = Tuple[str, bool, Optional[float]]
+# two operators, or an operator and the rate it is tested against
+Pair = Tuple[str, Union[str, float]]
+
+
+def is_admin(user) -> bool:
+    return user is not None and (str(user.id) in ADMINS or (user.username or '') in ADMINS)
+
+
+def credible_interval(pos: int, neg: int, level: float = CREDIBLE) -> Tuple[float, float]:
+    # Beta posterior of the rate under a uniform prior
+    low, high = stats.beta.ppf([(1 - level) / 2, (1 + level) / 2], pos + 1, neg + 1)
+    return float(low), float(high)
+
+
+def ztest(pos_a: int, n_a: int, pos_b: int, n_b: int) -> Tuple[float, float]:
+    """z and two-sided p-value of the pooled two-proportion z-test, as proportions_ztest."""
+    if not n_a or not n_b:
+        return math.nan, math.nan
+    pooled = (pos_a + pos_b) / (n_a + n_b)
+    se = math.sqrt(pooled * (1 - pooled) * (1 / n_a + 1 / n_b))
+    if se == 0:
+        return math.nan, math.nan
+    z = (pos_a / n_a - pos_b / n_b) / se
+    return z, math.erfc(abs(z) / math.sqrt(2))
+
+
+def sign_test(pos: int, n: int, rate: float = 0.5) -> float:
+    """Two-sided p-value of the exact binomial test of `pos` positives out of `n` against `rate`."""
+    if not n:
+        return math.nan
+    return float(stats.binomtest(pos, n, rate).pvalue)
+
+
+def is_one_sample(pair: Pair) -> bool:
+    return not isinstance(pair[1], str)
+
+
+def pair_operators(pair: Pair) -> List[str]:
+    return [pair[0]] if is_one_sample(pair) else list(pair)
+
+
+class Tallies:
+    """Counts of answers per operator and discriminator bucket, shared with forked processes.
+
+    `buckets` are the upper bounds of all buckets but the last; answers without a discriminator
+    score have a bucket of their own. `pairs` are the operator pairs the report tests, all pairs by
+    default. A pair of an operator and a rate, e.g. `('best', 0.5)`, tests the operator alone
+    against that rate, for answers that are not independent samples of two operators.
+    """
+
+    def __init__(self, operators: Sequence[str], pairs: Optional[Sequence[Pair]] = None,
+                 buckets: Sequence[float] = BUCKETS):
+        self.operators = list(operators)
+        self.index = {operator: i for i, operator in enumerate(self.operators)}
+        self.pairs = list(pairs) if pairs is not None else list(combinations(self.operators, 2))
+        self.buckets = list(buckets)
+        self.n_buckets = len(self.buckets) + 2
+        self.counts = multiprocessing.get_context('fork').Array('q', len(self.operators) * self.n_buckets * 2)
+        # called after the tallies of each answer are added, e.g. by sequential tests
+        self.listeners = []  # type: List[Callable[[], None]]
+        self.failures = 0
+
+    def _bucket(self, discriminator: Optional[float]) -> int:
+        if discriminator is None or math.isnan(discriminator):
+            return self.n_buckets - 1
+        return bisect.bisect_right(self.buckets, discriminator)
+
+    def add(self, operator: str, positive: bool, discriminator: Optional[float] = None):
+        i = (self.index[operator] * self.n_buckets + self._bucket(discriminator)) * 2 + bool(positive)
+        with self.counts.get_lock():
+            self.counts[i] += 1
+
+    def add_answer(self, tally: Sequence[Tally]):
+        """Adds the tallies of one recorded answer. A tally or listener that fails is logged and
+        counted in `failures`, and the others still run."""
+        for operator, positive, discriminator in tally:
+            try:
+                self.add(operator, positive, discriminator)
+            except Exception as e:
+                self._failed('tally {!r}'.format((operator, positive, discriminator)), e)
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                self._failed('listener {!r}'.format(listener), e)
+
+    def _failed(self, what: str, e: Exception):
+        self.failures += 1
+        print('tallies: {} failed ({} failures so far): {!r}'.format(what, self.failures, e))
+
+    def snapshot(self) -> List[List[List[int]]]:
+        """`[operator][bucket] -> [neg, pos]`"""
+        with self.counts.get_lock():
+            flat = self.counts[:]
+        return [[flat[(o * self.n_buckets + b) * 2:(o * self.n_buckets + b) * 2 + 2] for b in range(self.n_buckets)]
+                for o in range(len(self.operators))]
+
+    @staticmethod
+    def _totals(snapshot: List[List[List[int]]]) -> List[List[int]]:
+        return [[sum(c[0] for c in buckets), sum(c[1] for c in buckets)] for buckets in snapshot]
+
+    def totals(self) -> List[List[int]]:
+        """`[operator] -> [neg, pos]` over all buckets"""
+        return self._totals(self.snapshot())
+
+    def _bucket_name(self, b: int) -> str:
+        if b == self.n_buckets - 1:
+            return 'no score'
+        low = self.buckets[b - 1] if b > 0 else None
+        high = self.buckets[b] if b < len(self.buckets) else None
+        if low is None:
+            return '< {}'.format(high)
+        return '>= {}'.format(low) if high is None else '{}-{}'.format(low, high)
+
+    def report(self) -> str:
+        snapshot = self.snapshot()
+        totals = self._totals(snapshot)
+        width = max(len(operator) for operator in self.operators + ['operator'])
+        lines = ['{:{w}}  {:>6} {:>6} {:>6}  {:>5}  {:.0%} credible'.format(
+            'operator', 'n', 'pos', 'neg', 'rate', CREDIBLE, w=width)]
+        for operator, (neg, pos) in zip(self.operators, totals):
+            n = neg + pos
+            lines.append('{:{w}}  {:6} {:6} {:6}  {:5.3f}  {:.3f}-{:.3f}'.format(
+                operator, n, pos, neg, pos / n if n else math.nan, *credible_interval(pos, neg), w=width))
+
+        lines += ['', 'rate (n) by discriminator']
+        lines.append('{:10}'.format('') + ''.join(' {:>14}'.format(operator) for operator in self.operators))
+        for b in range(self.n_buckets):
+            cells = []
+            for buckets in snapshot:
+                neg, pos = buckets[b]
+                cells.append(' {:>14}'.format('{:.3f} ({})'.format(pos / (pos + neg), pos + neg) if pos + neg else '-'))
+            lines.append('{:10}'.format(self._bucket_name(b)) + ''.join(cells))
+
+        two_sample = [pair for pair in self.pairs if not is_one_sample(pair)]
+        if two_sample:
+            lines += ['', 'two-proportion z-test']
+        for a, b in two_sample:
+            (neg_a, pos_a), (neg_b, pos_b) = totals[self.index[a]], totals[self.index[b]]
+            z, p = ztest(pos_a, pos_a + neg_a, pos_b, pos_b + neg_b)
+            lines.append('{} vs {}: z = {:.3f}, p = {:.4g}'.format(a, b, z, p))
+        one_sample = [pair for pair in self.pairs if is_one_sample(pair)]
+        if one_sample:
+            lines += ['', 'sign test']
+        for a, rate in one_sample:
+            neg, pos = totals[self.index[a]]
+            lines.append('{} vs {}: p = {:.4g}'.format(a, rate, sign_test(pos, pos + neg, rate)))
+        return '\n'.join(lines)
+
+    def report_html(self) -> str:
+        return '<pre>{}</pre>'.format(html.escape(self.report()))
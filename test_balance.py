@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from balance import balance_index
+
+
+def test_default_truncates_to_smallest_operator():
+    operators = np.array([0, 0, 0, 1, 1, -1])
+    index = balance_index(operators, shuffle=False)
+    assert list(index) == [0, 1, 3, 4]
+
+
+def test_quotas_weights_and_bins():
+    operators = np.array([0, 0, 0, 1, 1, 1, 0, 1, 0])
+    scores = np.array([0.1, 0.2, 0.3, 0.1, 0.2, 0.3, 0.9, 0.8, np.nan])
+    # three rows of each operator below 0.5, one each in 0.5-0.95, none above, and a row without
+    # a score for operator 0 only
+    index = balance_index(operators, quotas={0: 1, 1: 1}, weights={0: 2.0, 1: 1.0}, scores=scores,
+                          bins=[0.5, 0.95], shuffle=False)
+    assert list(index) == [0, 3, 6, 7]
+
+
+def test_quotas_skip_unscored_bin():
+    operators = np.array([0, 1, 0])
+    scores = np.array([0.1, 0.2, np.nan])
+    index = balance_index(operators, quotas={0: 1, 1: 1}, scores=scores, bins=[0.5], shuffle=False)
+    assert list(index) == [0, 1]
+
+
+def test_quota_short_in_scored_bin():
+    operators = np.array([0, 0, 1])
+    scores = np.array([0.1, 0.2, 0.9])
+    with pytest.raises(ValueError):
+        balance_index(operators, quotas={0: 1, 1: 1}, scores=scores, bins=[0.5])